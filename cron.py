@@ -23,6 +23,7 @@ __author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
 
 # General libraries
 import datetime
+import time
 
 # App engine specific libraries
 import webapp2
@@ -32,10 +33,19 @@ from google_api_utils import InitCredentials
 from handler_utils import ExtendedHandler
 from library import MonthlyCleanup
 from library import UpdateUserSubscriptions
+from models import GetCalendarPool
 from models import UserCal
+from quota_utils import GetAPIUsage
+from quota_utils import SecondsUntilTomorrow
+from reconcile import ReconcileCalendar
 from time_utils import ConvertToInterval
 
 
+# Spacing between the tasks started by a single cron run, so that every user
+# scheduled in the same interval doesn't hit the API at the same moment
+TASK_SPACING = 2  # seconds
+
+
 class MainHandler(ExtendedHandler):
   """Handles cron requests to /cron.
 
@@ -58,14 +68,22 @@ class MainHandler(ExtendedHandler):
     now_interval = ConvertToInterval(now)
     credentials = None
 
+    # Apply backpressure: if the daily API budget is already used up, start
+    # the updates once it resets rather than having every task defer itself.
+    usage = GetAPIUsage()
+    base_countdown = 0
+    if usage['day'] >= usage['calls_per_day']:
+      base_countdown = SecondsUntilTomorrow(time.time())
+
     current_users = UserCal.query(UserCal.update_intervals == now_interval)
-    for user_cal in current_users:
+    for index, user_cal in enumerate(current_users):
       if user_cal.calendars:
         if credentials is None:
           credentials = InitCredentials()
+        countdown = base_countdown + index * TASK_SPACING
         # pylint:disable-msg=E1123
         UpdateUserSubscriptions(user_cal, credentials=credentials,
-                                defer_now=True)
+                                defer_now=True, _countdown=countdown)
 
 
 class CleanupHandler(ExtendedHandler):
@@ -83,7 +101,25 @@ class CleanupHandler(ExtendedHandler):
     MonthlyCleanup(now.date(), defer_now=True)  # pylint:disable-msg=E1123
 
 
+class ReconcileHandler(ExtendedHandler):
+  """Handles cron requests to /cron-reconcile.
+
+  Compares the events changed on each calendar in the pool since the last run
+  against the datastore by using ReconcileCalendar.
+  """
+
+  def get(self):  # pylint:disable-msg=C0103
+    """Updates once a day."""
+    if self.request.headers.get('X-AppEngine-Cron', '') != 'true':
+      return
+
+    for calendar_id in GetCalendarPool():
+      # pylint:disable-msg=E1123
+      ReconcileCalendar(calendar_id=calendar_id, defer_now=True)
+
+
 APPLICATION = webapp2.WSGIApplication([
     ('/cron', MainHandler),
     ('/cron-monthly', CleanupHandler),
+    ('/cron-reconcile', ReconcileHandler),
     ], debug=True)
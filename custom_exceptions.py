@@ -43,3 +43,32 @@ class MissingUID(Error):
 
 class UnexpectedDescription(Error):
   """Error corresponding to an unexpected event description."""
+
+
+class OutOfTime(Error):
+  """Error signalling that a task has used up its time budget.
+
+  Raised only where the stored state is consistent, so the caller can save its
+  progress and re-defer the remaining work straight away.
+  """
+
+
+class RetryLater(Error):
+  """Error signalling that API work should be retried after a delay.
+
+  Raised instead of sleeping when a backoff is too long to wait out inside a
+  request. Callers are expected to re-defer the remaining work with {delay}
+  as the task countdown.
+  """
+
+  def __init__(self, delay, results=None):
+    """Constructor for RetryLater.
+
+    Args:
+      delay: The number of seconds to wait before retrying.
+      results: An optional list of results of the work which did complete
+          before the error was raised.
+    """
+    super(RetryLater, self).__init__(delay)
+    self.delay = delay
+    self.results = results
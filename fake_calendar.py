@@ -0,0 +1,521 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-process stand-in for the Calendar v3 events service.
+
+FakeCalendarHttp acts like an httplib2.Http and answers the requests made by
+a service built from DISCOVERY_DOC (a minimal local copy of the Calendar v3
+discovery document), including batch requests. It keeps events in memory and
+supports simulated latency, injected errors (403 rate limits and 5xx) and
+per-second and per-day quota, so throughput and retry behaviour can be
+measured without the real API:
+
+  fake_http = FakeCalendarHttp(latency=0.05, calls_per_second=10)
+  credentials = fake_calendar.Install(fake_http)
+  # google_api_utils calls made with these credentials now go to fake_http
+  fake_http.inject_errors(503, 503)  # fail the next two calls
+  ...
+  print fake_http.stats
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# General libraries
+import collections
+import copy
+import datetime
+import email.feedparser
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+# Third-party libraries
+from apiclient.discovery import build_from_document
+import httplib2
+
+
+BATCH_URI = 'https://www.googleapis.com/batch'
+ROOT_URL = 'https://www.googleapis.com/'
+SERVICE_PATH = 'calendar/v3/'
+EVENTS_PATH = re.compile(r'^/calendar/v3/calendars/(?P<calendar_id>[^/]+)'
+                         r'/events(/(?P<event_id>[^/]+))?$')
+ERROR_REASONS = {403: 'rateLimitExceeded',
+                 404: 'notFound',
+                 409: 'duplicate',
+                 410: 'fullSyncRequired',
+                 500: 'backendError',
+                 503: 'backendError'}
+STATUS_REASONS = {200: 'OK', 204: 'No Content', 403: 'Forbidden',
+                  404: 'Not Found', 409: 'Conflict', 410: 'Gone',
+                  500: 'Internal Server Error', 503: 'Service Unavailable'}
+# Distinguishes the credentials of each Install, see FakeCredentials
+CREDENTIALS_IDS = itertools.count(1)
+# State of google_api_utils replaced by Install, restored by Uninstall
+INSTALLED = {}
+
+
+def _Method(method_id, http_method, path, parameters, request=False):
+  """Builds the discovery description of an events method."""
+  description = {'id': 'calendar.events.' + method_id,
+                 'path': path,
+                 'httpMethod': http_method,
+                 'parameters': parameters,
+                 'response': {'$ref': 'Event'}}
+  if request:
+    description['request'] = {'$ref': 'Event'}
+  if http_method == 'DELETE':
+    del description['response']
+  return description
+
+
+_CALENDAR_ID = {'type': 'string', 'required': True, 'location': 'path'}
+_EVENT_ID = {'type': 'string', 'required': True, 'location': 'path'}
+_QUERY_STRING = {'type': 'string', 'location': 'query'}
+_QUERY_INTEGER = {'type': 'integer', 'location': 'query'}
+_QUERY_BOOLEAN = {'type': 'boolean', 'location': 'query'}
+DISCOVERY_DOC = {
+    'kind': 'discovery#restDescription',
+    'discoveryVersion': 'v1',
+    'id': 'calendar:v3',
+    'name': 'calendar',
+    'version': 'v3',
+    'protocol': 'rest',
+    'rootUrl': ROOT_URL,
+    'servicePath': SERVICE_PATH,
+    'batchPath': 'batch',
+    'parameters': {'key': _QUERY_STRING},
+    'schemas': {'Event': {'id': 'Event', 'type': 'object'},
+                'Events': {'id': 'Events', 'type': 'object'}},
+    'resources': {'events': {'methods': {
+        'insert': _Method('insert', 'POST', 'calendars/{calendarId}/events',
+                          {'calendarId': _CALENDAR_ID}, request=True),
+        'get': _Method('get', 'GET',
+                       'calendars/{calendarId}/events/{eventId}',
+                       {'calendarId': _CALENDAR_ID, 'eventId': _EVENT_ID}),
+        'update': _Method('update', 'PUT',
+                          'calendars/{calendarId}/events/{eventId}',
+                          {'calendarId': _CALENDAR_ID, 'eventId': _EVENT_ID},
+                          request=True),
+        'patch': _Method('patch', 'PATCH',
+                         'calendars/{calendarId}/events/{eventId}',
+                         {'calendarId': _CALENDAR_ID, 'eventId': _EVENT_ID},
+                         request=True),
+        'delete': _Method('delete', 'DELETE',
+                          'calendars/{calendarId}/events/{eventId}',
+                          {'calendarId': _CALENDAR_ID, 'eventId': _EVENT_ID}),
+        'list': dict(_Method('list', 'GET', 'calendars/{calendarId}/events',
+                             {'calendarId': _CALENDAR_ID,
+                              'maxResults': _QUERY_INTEGER,
+                              'pageToken': _QUERY_STRING,
+                              'showDeleted': _QUERY_BOOLEAN,
+                              'syncToken': _QUERY_STRING}),
+                     response={'$ref': 'Events'}),
+    }}},
+}
+
+
+def MergePatch(resource, body):
+  """Applies a patch body to a resource as the API does.
+
+  Nested objects are merged rather than replaced, and null values remove the
+  key from the resource.
+
+  Args:
+    resource: A dictionary, updated in place.
+    body: The dictionary sent as the body of the patch.
+  """
+  for key, value in body.iteritems():
+    if value is None:
+      resource.pop(key, None)
+    elif isinstance(value, dict) and isinstance(resource.get(key), dict):
+      MergePatch(resource[key], value)
+    else:
+      resource[key] = value
+
+
+class FakeCalendarHttp(object):
+  """An httplib2.Http stand-in serving the Calendar v3 events service.
+
+  Every call, including each sub-request of a batch, is counted against the
+  quota. Deleted events are kept as cancelled tombstones so that listings
+  with a syncToken report them.
+
+  Attributes:
+    calendars: A dictionary mapping each calendar ID to a dictionary of the
+        events in it, keyed by event ID.
+    stats: A collections.Counter of calls made, keyed by method (e.g. insert)
+        and by the status of each error returned (e.g. 'status:503').
+  """
+
+  def __init__(self, latency=0.0, error_rate=0.0, error_statuses=(403, 503),
+               calls_per_second=None, calls_per_day=None, seed=None):
+    """Constructor for FakeCalendarHttp.
+
+    Args:
+      latency: Seconds each HTTP request (a batch counts once) takes.
+      error_rate: Probability in [0, 1] that a call fails with a status chosen
+          from {error_statuses}.
+      error_statuses: The statuses used for random errors; 403 is returned
+          with a rateLimitExceeded reason and 5xx with backendError.
+      calls_per_second: Calls allowed in each second before further calls
+          fail with 403 userRateLimitExceeded. Defaults to no limit.
+      calls_per_day: Calls allowed in total before further calls fail with
+          403 dailyLimitExceeded. Defaults to no limit.
+      seed: Optional seed for the random errors.
+    """
+    self.latency = latency
+    self.error_rate = error_rate
+    self.error_statuses = tuple(error_statuses)
+    self.calls_per_second = calls_per_second
+    self.calls_per_day = calls_per_day
+
+    self.calendars = collections.defaultdict(dict)
+    self.stats = collections.Counter()
+
+    self._random = random.Random(seed)
+    self._injected = collections.deque()
+    self._lock = threading.Lock()
+    self._ids = itertools.count(1)
+    self._changes = itertools.count(1)
+    self._second = None
+    self._second_calls = 0
+    self._day_calls = 0
+
+  def build_service(self):
+    """Builds a service object which sends its requests to this fake."""
+    return build_from_document(DISCOVERY_DOC, http=self)
+
+  def inject_errors(self, *statuses):
+    """Makes the next calls fail, one per status given, before any others."""
+    with self._lock:
+      self._injected.extend(statuses)
+
+  def request(self, uri, method='GET', body=None, headers=None,
+              redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+              connection_type=None):
+    """Answers an HTTP request as httplib2.Http.request would.
+
+    Args:
+      uri: The URI of the request.
+      method: The HTTP method of the request.
+      body: The body of the request, if any.
+      headers: A dictionary of request headers.
+      redirections: Ignored, accepted for compatibility.
+      connection_type: Ignored, accepted for compatibility.
+
+    Returns:
+      A pair (response, content) of an httplib2.Response and a string.
+    """
+    # pylint:disable-msg=W0613
+    if self.latency:
+      time.sleep(self.latency)
+
+    if uri.split('?', 1)[0] == BATCH_URI:
+      return self._batch(body, headers or {})
+
+    status, response_headers, content = self._call(method, uri, body)
+    response = httplib2.Response(response_headers)
+    response.status = status
+    response.reason = STATUS_REASONS.get(status, '')
+    return response, content
+
+  def _batch(self, body, headers):
+    """Answers a multipart/mixed batch request."""
+    parser = email.feedparser.FeedParser()
+    parser.feed('content-type: {}\r\n\r\n'.format(headers['content-type']))
+    parser.feed(body)
+
+    parts = []
+    for part in parser.close().get_payload():
+      request_line, payload = part.get_payload().split('\n', 1)
+      method, path, _ = request_line.split(' ', 2)
+      sub_parser = email.feedparser.FeedParser()
+      sub_parser.feed(payload)
+      sub_request = sub_parser.close()
+      status, _, content = self._call(method, path,
+                                      sub_request.get_payload() or None)
+      parts.append(
+          '--batch_fake\r\nContent-Type: application/http\r\n'
+          'Content-ID: <response-{content_id}>\r\n\r\n'
+          'HTTP/1.1 {status:d} {reason}\r\n'
+          'Content-Type: application/json\r\n\r\n{content}\r\n'.format(
+              content_id=part['Content-ID'][1:-1], status=status,
+              reason=STATUS_REASONS.get(status, ''), content=content))
+
+    response = httplib2.Response(
+        {'content-type': 'multipart/mixed; boundary=batch_fake'})
+    response.status = 200
+    response.reason = 'OK'
+    return response, ''.join(parts) + '--batch_fake--\r\n'
+
+  def _call(self, method, uri, body):
+    """Answers a single events call after applying quota and errors.
+
+    Returns:
+      A triple (status, headers, content).
+    """
+    with self._lock:
+      error = self._quota_error() or self._forced_error()
+      if error is not None:
+        return self._error(*error)
+
+      parsed = urlparse.urlparse(uri)
+      match = EVENTS_PATH.match(parsed.path)
+      if match is None:
+        return self._error(404, 'notFound')
+
+      query = dict(urlparse.parse_qsl(parsed.query))
+      calendar_id = urllib.unquote(match.group('calendar_id'))
+      event_id = match.group('event_id')
+      if event_id is not None:
+        event_id = urllib.unquote(event_id)
+      body = json.loads(body) if body else {}
+
+      if event_id is None:
+        if method == 'POST':
+          return self._insert(calendar_id, body)
+        return self._list(calendar_id, query)
+      return self._event_call(method, calendar_id, event_id, body)
+
+  def _quota_error(self):
+    """Accounts for a call against the quota, returning an error if over."""
+    if self.calls_per_day is not None and self._day_calls >= self.calls_per_day:
+      return 403, 'dailyLimitExceeded'
+    self._day_calls += 1
+
+    second = int(time.time())
+    if second != self._second:
+      self._second = second
+      self._second_calls = 0
+    self._second_calls += 1
+    if (self.calls_per_second is not None and
+        self._second_calls > self.calls_per_second):
+      return 403, 'userRateLimitExceeded'
+    return None
+
+  def _forced_error(self):
+    """Returns an injected or random error for a call, if any."""
+    status = None
+    if self._injected:
+      status = self._injected.popleft()
+    elif self.error_rate and self._random.random() < self.error_rate:
+      status = self._random.choice(self.error_statuses)
+
+    if status is None:
+      return None
+    return status, ERROR_REASONS.get(status, 'backendError')
+
+  def _error(self, status, reason):
+    """Answers a call with an error in the format used by the API."""
+    self.stats['status:{:d}'.format(status)] += 1
+    content = json.dumps({'error': {
+        'errors': [{'domain': 'global', 'reason': reason, 'message': reason}],
+        'code': status, 'message': reason}})
+    return status, {'content-type': 'application/json'}, content
+
+  def _ok(self, resource):
+    """Answers a successful call with a JSON resource (or no content)."""
+    if resource is None:
+      return 204, {}, ''
+    return 200, {'content-type': 'application/json'}, json.dumps(resource)
+
+  def _store(self, calendar_id, event):
+    """Stores an event, recording the change for syncToken listings."""
+    event['updated_change'] = self._changes.next()
+    self.calendars[calendar_id][event['id']] = event
+
+  def _insert(self, calendar_id, body):
+    """Answers events().insert, honoring an ID given in the body.
+
+    As with the API, an ID can't be reused, even once its event is deleted.
+    """
+    self.stats['insert'] += 1
+    event = copy.deepcopy(body)
+    if event.get('id') is None:
+      event['id'] = 'fake{:d}'.format(self._ids.next())
+    elif event['id'] in self.calendars[calendar_id]:
+      return self._error(409, 'duplicate')
+    event['status'] = 'confirmed'
+    event.setdefault('sequence', 0)
+    self._store(calendar_id, event)
+    return self._ok(self._public(event))
+
+  def _event_call(self, method, calendar_id, event_id, body):
+    """Answers events().get, update, patch and delete."""
+    event = self.calendars[calendar_id].get(event_id)
+    if event is None or event['status'] == 'cancelled':
+      return self._error(404, 'notFound')
+
+    if method == 'GET':
+      self.stats['get'] += 1
+      return self._ok(self._public(event))
+    elif method == 'DELETE':
+      self.stats['delete'] += 1
+      self._store(calendar_id, {'id': event_id, 'status': 'cancelled'})
+      return self._ok(None)
+
+    if method == 'PUT':
+      self.stats['update'] += 1
+      updated = copy.deepcopy(body)
+    else:
+      self.stats['patch'] += 1
+      updated = copy.deepcopy(event)
+      MergePatch(updated, copy.deepcopy(body))
+    updated['id'] = event_id
+    updated['status'] = 'confirmed'
+    updated['sequence'] = max(updated.get('sequence', 0),
+                              event.get('sequence', 0))
+    self._store(calendar_id, updated)
+    return self._ok(self._public(updated))
+
+  def _list(self, calendar_id, query):
+    """Answers events().list, with paging and incremental sync."""
+    self.stats['list'] += 1
+    events = sorted(self.calendars[calendar_id].itervalues(),
+                    key=lambda event: event['updated_change'])
+    if 'syncToken' in query:
+      if not query['syncToken'].isdigit():
+        return self._error(410, 'fullSyncRequired')
+      since = int(query['syncToken'])
+      events = [event for event in events if event['updated_change'] > since]
+    elif query.get('showDeleted') != 'true':
+      events = [event for event in events if event['status'] != 'cancelled']
+
+    start = int(query.get('pageToken', 0))
+    end = start + int(query.get('maxResults', 250))
+    result = {'kind': 'calendar#events',
+              'items': [self._public(event) for event in events[start:end]]}
+    if end < len(events):
+      result['nextPageToken'] = str(end)
+    else:
+      last_change = max([0] + [event['updated_change'] for event in
+                               self.calendars[calendar_id].itervalues()])
+      result['nextSyncToken'] = str(last_change)
+    return self._ok(result)
+
+  @staticmethod
+  def _public(event):
+    """Returns the event resource without the fake's bookkeeping."""
+    resource = dict(event)
+    resource.pop('updated_change', None)
+    return resource
+
+
+class FakeCredentials(object):  # pylint:disable-msg=R0903
+  """Credentials which authorize requests against a FakeCalendarHttp.
+
+  Provides only the parts of OAuth2Credentials used by google_api_utils. The
+  access token has no expiry, so it is never refreshed.
+  """
+
+  def __init__(self, fake_http):
+    """Constructor for FakeCredentials.
+
+    Args:
+      fake_http: The FakeCalendarHttp which requests are sent to.
+    """
+    self.fake_http = fake_http
+    self.client_id = 'fake-client'
+    # Http's and services are cached by identity, so each fake needs its own
+    self.refresh_token = 'fake-{:d}'.format(CREDENTIALS_IDS.next())
+    self.access_token = 'fake-access-token'
+    self.token_expiry = None
+    self.invalid = False
+
+  def authorize(self, http):
+    """Returns the fake in place of {http}, so every request is sent to it."""
+    # pylint:disable-msg=W0613
+    return self.fake_http
+
+
+def Install(fake_http):
+  """Routes the requests made by google_api_utils to a fake.
+
+  The local DISCOVERY_DOC is seeded into the discovery cache (along with a
+  developer key, if none has been read yet), so services are built by
+  DiscoveryDocument.build and cached as usual. The fake is only reached
+  through the Http's authorized by the credentials returned, which must be
+  passed to google_api_utils; the default credentials still use the real API.
+
+  Args:
+    fake_http: A FakeCalendarHttp instance.
+
+  Returns:
+    A FakeCredentials object authorizing requests against {fake_http}.
+  """
+  # Imported here so the fake can be used without the App Engine SDK, e.g.
+  # directly through FakeCalendarHttp.build_service.
+  import google_api_utils  # pylint:disable-msg=W0404
+
+  Uninstall()
+  key = DiscoveryKey()
+  discovery_doc = google_api_utils.DiscoveryDocument(
+      key=key, document=json.dumps(DISCOVERY_DOC),
+      updated=datetime.datetime.max)
+  INSTALLED['DISCOVERY'] = google_api_utils.DISCOVERY_CACHE.get(key)
+  google_api_utils.DISCOVERY_CACHE[key] = (DISCOVERY_DOC, discovery_doc)
+
+  if 'DEVELOPER_KEY' not in google_api_utils.SECRET_KEY:
+    google_api_utils.SECRET_KEY['DEVELOPER_KEY'] = 'fake-developer-key'
+    INSTALLED['DEVELOPER_KEY'] = True
+
+  credentials = FakeCredentials(fake_http)
+  INSTALLED['CREDENTIALS'] = credentials
+  return credentials
+
+
+def Uninstall():
+  """Restores the state of google_api_utils replaced by Install."""
+  if not INSTALLED:
+    return
+
+  import google_api_utils  # pylint:disable-msg=W0404
+
+  key = DiscoveryKey()
+  previous = INSTALLED.pop('DISCOVERY')
+  if previous is None:
+    google_api_utils.DISCOVERY_CACHE.pop(key, None)
+  else:
+    google_api_utils.DISCOVERY_CACHE[key] = previous
+
+  if INSTALLED.pop('DEVELOPER_KEY', False):
+    google_api_utils.SECRET_KEY.pop('DEVELOPER_KEY', None)
+
+  identity = google_api_utils.CredentialsIdentity(INSTALLED.pop('CREDENTIALS'))
+  with google_api_utils.SERVICE_CACHE_LOCK:
+    google_api_utils.SERVICE_CACHE.pop(identity, None)
+    google_api_utils.WORKER_HTTP_POOL.pop(identity, None)
+
+
+def DiscoveryKey():
+  """Gets the key the calendar discovery document is cached under."""
+  # pylint:disable-msg=W0404
+  from apiclient.discovery import DISCOVERY_URI
+  import google_api_utils
+  from google.appengine.ext import ndb
+
+  doc_model = google_api_utils.DiscoveryDocument
+  return ndb.Key(doc_model, google_api_utils.CALENDAR_API_NAME,
+                 doc_model, google_api_utils.CALENDAR_API_VERSION,
+                 doc_model, DISCOVERY_URI)
@@ -23,9 +23,13 @@ __author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
 
 # General libraries
 import datetime
+import hashlib
 import json
 import logging
 import os
+import Queue
+import random
+import threading
 import time
 
 # Third-party libraries
@@ -34,24 +38,48 @@ from apiclient.discovery import _add_query_parameter
 from apiclient.discovery import build_from_document
 from apiclient.errors import HttpError
 from apiclient.errors import InvalidJsonError
+from apiclient.http import BatchHttpRequest
 import httplib2
 from oauth2client.appengine import CredentialsModel
 from oauth2client.appengine import StorageByKeyName
 import uritemplate
 
 # App engine specific libraries
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 # App specific libraries
 from custom_exceptions import CredentialsLoadError
+from custom_exceptions import RetryLater
+from handler_utils import DeferFunctionDecorator
+from quota_utils import AcquireAPIQuota
 
 
+BACKOFF_BASE = 1  # seconds
+BACKOFF_MAX_SLEEP = 8  # seconds, longer waits are deferred to a new task
+BATCH_SIZE = 50  # maximum number of calls in a Calendar API batch request
 CALENDAR_API_NAME = 'calendar'
 CALENDAR_API_VERSION = 'v3'
 CREDENTIALS_KEYNAME = 'calendar.dat'
+DISCOVERY_CACHE = {}
 DISCOVERY_DOC_MAX_AGE = datetime.timedelta(days=7)
+DISCOVERY_REFRESH_LOCK_TIMEOUT = 10 * 60  # seconds
+MAX_CONCURRENT_BATCHES = 4  # batch requests in flight at once within a task
+# The error recorded for a batched request which was never sent
+NOT_SENT = object()
+HTTP_LOCAL = threading.local()
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
 SECRET_KEY = {}
 SECRET_KEY_DB_KEY = 'secret_key'
+SERVICE_CACHE = {}
+SERVICE_CACHE_LOCK = threading.Lock()
+SERVICE_CACHE_TTL = 60 * 60  # seconds
+# Idle authorized Http's for batch worker threads, by credentials identity
+WORKER_HTTP_POOL = {}
+TOKEN_LOCK_TIMEOUT = 30  # seconds
+TOKEN_NAMESPACE = 'oauth-token'
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+TOKEN_WAIT_INTERVAL = 0.25  # seconds
 
 
 class SecretKey(ndb.Model):
@@ -62,7 +90,12 @@ class SecretKey(ndb.Model):
 
 
 class DiscoveryDocument(ndb.Model):
-  """Model for representing a discovery document."""
+  """Model for representing a discovery document.
+
+  The parsed document is also held in memory (DISCOVERY_CACHE) so that it is
+  only parsed once per instance. An expired document is still used while a
+  deferred task fetches a new one, so no request waits on the refresh.
+  """
   document = ndb.StringProperty(required=True, indexed=False)
   updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
@@ -72,25 +105,71 @@ class DiscoveryDocument(ndb.Model):
     return now - self.updated > DISCOVERY_DOC_MAX_AGE
 
   @classmethod
-  def build(cls, serviceName, version, credentials, **kwargs):
-    discoveryServiceUrl = kwargs.pop('discoveryServiceUrl', DISCOVERY_URI)
+  def get_parsed(cls, serviceName, version, credentials,
+                 discoveryServiceUrl=DISCOVERY_URI):
+    """Gets the parsed discovery document, fetching it only if there is none.
+
+    Args:
+      serviceName: The name of the API, e.g. calendar.
+      version: The version of the API, e.g. v3.
+      credentials: An OAuth2Credentials object, used if the document must be
+          fetched synchronously.
+      discoveryServiceUrl: The URI template for discovery documents.
+
+    Returns:
+      The discovery document as a dictionary.
+    """
     key = ndb.Key(cls, serviceName, cls, version, cls, discoveryServiceUrl)
-    discovery_doc = key.get()
+    cached = DISCOVERY_CACHE.get(key)
+    if cached is not None and not cached[1].expired:
+      return cached[0]
 
-    if discovery_doc is None or discovery_doc.expired:
-      # If None, RetrieveDiscoveryDoc() will use Defaults
+    discovery_doc = key.get()
+    if discovery_doc is None:
+      # Nothing to serve while refreshing, so fetch it now
       document = RetrieveDiscoveryDoc(
           serviceName, version, credentials=credentials,
           discoveryServiceUrl=discoveryServiceUrl)
       discovery_doc = cls(key=key, document=document)
       discovery_doc.put()
+    elif discovery_doc.expired:
+      # Only one refresh task is enqueued until it has had time to finish
+      if memcache.add('refresh:' + key.urlsafe(), 1,
+                      time=DISCOVERY_REFRESH_LOCK_TIMEOUT):
+        # pylint:disable-msg=E1123
+        RefreshDiscoveryDoc(serviceName, version, discoveryServiceUrl,
+                            defer_now=True)
+
+    if cached is None or cached[1].updated != discovery_doc.updated:
+      cached = (json.loads(discovery_doc.document), discovery_doc)
+      DISCOVERY_CACHE[key] = cached
+    return cached[0]
+
+  @classmethod
+  def build(cls, serviceName, version, credentials, **kwargs):
+    discoveryServiceUrl = kwargs.pop('discoveryServiceUrl', DISCOVERY_URI)
+    service = cls.get_parsed(serviceName, version, credentials,
+                             discoveryServiceUrl=discoveryServiceUrl)
+
+    if kwargs.get('http', None) is None:
+      kwargs['http'] = AuthorizedHttp(credentials)
+    return build_from_document(service, discoveryServiceUrl, **kwargs)
 
-    http = kwargs.get('http', None)
-    if http is None:
-      http = httplib2.Http()
-      kwargs['http'] = credentials.authorize(http)
-    return build_from_document(
-        discovery_doc.document, discoveryServiceUrl, **kwargs)
+
+@DeferFunctionDecorator
+def RefreshDiscoveryDoc(serviceName, version, discoveryServiceUrl):
+  """Fetches a discovery document and stores it, replacing an expired one.
+
+  Args:
+    serviceName: The name of the API, e.g. calendar.
+    version: The version of the API, e.g. v3.
+    discoveryServiceUrl: The URI template for discovery documents.
+  """
+  key = ndb.Key(DiscoveryDocument, serviceName, DiscoveryDocument, version,
+                DiscoveryDocument, discoveryServiceUrl)
+  document = RetrieveDiscoveryDoc(serviceName, version,
+                                  discoveryServiceUrl=discoveryServiceUrl)
+  DiscoveryDocument(key=key, document=document).put()
 
 
 def InitCredentials(keyname=CREDENTIALS_KEYNAME):
@@ -112,9 +191,192 @@ def InitCredentials(keyname=CREDENTIALS_KEYNAME):
   return credentials
 
 
+def GetDeveloperKey():
+  """Gets the developer key, reading the SecretKey from the datastore once.
+
+  Returns:
+    The developer key string stored on the project SecretKey.
+  """
+  if 'DEVELOPER_KEY' not in SECRET_KEY:
+    with SERVICE_CACHE_LOCK:
+      if 'DEVELOPER_KEY' not in SECRET_KEY:
+        secret_key = ndb.Key(SecretKey, SECRET_KEY_DB_KEY).get()
+        SECRET_KEY['DEVELOPER_KEY'] = secret_key.developer_key
+
+  return SECRET_KEY['DEVELOPER_KEY']
+
+
+def CredentialsIdentity(credentials):
+  """Computes a hashable identity for a credentials object.
+
+  Two credentials objects loaded from the same stored credentials share an
+  identity even though they are distinct objects (and may hold different
+  access tokens).
+
+  Args:
+    credentials: An OAuth2Credentials object.
+
+  Returns:
+    A tuple identifying the client and refresh token of {credentials}.
+  """
+  return (credentials.client_id, credentials.refresh_token)
+
+
+def TokenIsFresh(access_token, token_expiry):
+  """Determines if an access token can be used without a refresh.
+
+  Args:
+    access_token: The access token string, possibly None.
+    token_expiry: A datetime.datetime (UTC) when the token expires, or None if
+        the expiry is not known.
+
+  Returns:
+    Boolean indicating whether the token is set and will not expire within
+        TOKEN_REFRESH_MARGIN.
+  """
+  if not access_token:
+    return False
+  if token_expiry is None:
+    return True
+  return token_expiry - datetime.datetime.utcnow() > TOKEN_REFRESH_MARGIN
+
+
+def EnsureFreshToken(credentials):
+  """Refreshes the access token of a credentials object ahead of its expiry.
+
+  Access tokens are shared between instances through memcache. At most one
+  thread (across all instances) refreshes a given token at a time; the others
+  wait for the refreshed token to appear in memcache rather than refreshing it
+  again.
+
+  Args:
+    credentials: An OAuth2Credentials object.
+  """
+  if TokenIsFresh(credentials.access_token, credentials.token_expiry):
+    return
+
+  token_key = hashlib.sha1(repr(CredentialsIdentity(credentials))).hexdigest()
+  lock_key = 'lock:' + token_key
+
+  # If the lock holder never finishes, we fall through and refresh anyway
+  locked = False
+  deadline = time.time() + TOKEN_LOCK_TIMEOUT
+  while time.time() < deadline:
+    cached = memcache.get(token_key, namespace=TOKEN_NAMESPACE)
+    if cached is not None and TokenIsFresh(*cached):
+      credentials.access_token, credentials.token_expiry = cached
+      return
+
+    locked = memcache.add(lock_key, 1, time=TOKEN_LOCK_TIMEOUT,
+                          namespace=TOKEN_NAMESPACE)
+    if locked:
+      break
+    time.sleep(TOKEN_WAIT_INTERVAL)
+
+  try:
+    credentials.refresh(httplib2.Http())
+    logging.info('Access token refreshed')
+    memcache.set(token_key,
+                 (credentials.access_token, credentials.token_expiry),
+                 namespace=TOKEN_NAMESPACE)
+  finally:
+    if locked:
+      memcache.delete(lock_key, namespace=TOKEN_NAMESPACE)
+
+
+def AuthorizedHttp(credentials):
+  """Gets an authorized httplib2.Http for the current thread.
+
+  An httplib2.Http keeps its connections open between requests but is not
+  thread-safe, so one authorized Http is kept per thread for each credentials
+  identity. The access token is refreshed ahead of expiry before the Http is
+  returned.
+
+  Args:
+    credentials: An OAuth2Credentials object.
+
+  Returns:
+    An httplib2.Http authorized with {credentials} (or with an earlier
+        credentials object of the same identity).
+  """
+  pool = getattr(HTTP_LOCAL, 'pool', None)
+  if pool is None:
+    pool = HTTP_LOCAL.pool = {}
+
+  identity = CredentialsIdentity(credentials)
+  if identity not in pool:
+    pool[identity] = (credentials, credentials.authorize(httplib2.Http()))
+
+  bound_credentials, http = pool[identity]
+  EnsureFreshToken(bound_credentials)
+  return http
+
+
+def CheckoutHttp(credentials):
+  """Takes an authorized httplib2.Http for a batch worker thread.
+
+  Worker threads only live for one ExecuteBatches call, so rather than one
+  Http per thread (see AuthorizedHttp) they share a pool of idle Http's which
+  keep their connections open between calls. An Http is used by one thread
+  at a time and must be returned with CheckinHttp.
+
+  Args:
+    credentials: An OAuth2Credentials object.
+
+  Returns:
+    A pair (credentials, http) of an authorized httplib2.Http and the
+        credentials bound to it.
+  """
+  identity = CredentialsIdentity(credentials)
+  with SERVICE_CACHE_LOCK:
+    idle = WORKER_HTTP_POOL.setdefault(identity, [])
+    checked_out = idle.pop() if idle else None
+  if checked_out is None:
+    checked_out = (credentials, credentials.authorize(httplib2.Http()))
+
+  EnsureFreshToken(checked_out[0])
+  return checked_out
+
+
+def CheckinHttp(checked_out):
+  """Returns an Http taken with CheckoutHttp to the pool of idle Http's.
+
+  Args:
+    checked_out: A pair (credentials, http) returned by CheckoutHttp, or None.
+  """
+  if checked_out is None:
+    return
+
+  identity = CredentialsIdentity(checked_out[0])
+  with SERVICE_CACHE_LOCK:
+    WORKER_HTTP_POOL.setdefault(identity, []).append(checked_out)
+
+
+def ResolveCredentials(credentials=None, keyname=CREDENTIALS_KEYNAME):
+  """Loads the default credentials if none are passed in.
+
+  Args:
+    credentials: An OAuth2Credentials object, or None.
+    keyname: The key name of the credentials object in the data store. Defaults
+        to CREDENTIALS_KEYNAME.
+
+  Returns:
+    {credentials} if set, otherwise the credentials found at key {keyname}.
+  """
+  if credentials is not None:
+    return credentials
+  return InitCredentials(keyname=keyname)
+
+
 def InitService(credentials=None, keyname=CREDENTIALS_KEYNAME):
   """Initializes a service object to make calendar requests.
 
+  Service objects are cached per instance for SERVICE_CACHE_TTL seconds, keyed
+  by the identity of the credentials, and shared by every thread. The
+  authorized httplib2.Http wrapped by a service is not thread-safe, so
+  requests are executed with the Http of the calling thread instead (see
+  AuthorizedHttp and CheckoutHttp).
+
   Args:
     credentials: An OAuth2Credentials object used to build a service object.
         In the case the credentials is None, attempt to get credentials using
@@ -132,14 +394,22 @@ def InitService(credentials=None, keyname=CREDENTIALS_KEYNAME):
   if credentials is None:
     credentials = InitCredentials(keyname=keyname)
 
-  if 'DEVELOPER_KEY' not in SECRET_KEY:
-    secret_key = ndb.Key(SecretKey, SECRET_KEY_DB_KEY).get()
-    SECRET_KEY['DEVELOPER_KEY'] = secret_key.developer_key
+  cache_key = CredentialsIdentity(credentials)
+  now = time.time()
+  with SERVICE_CACHE_LOCK:
+    cached = SERVICE_CACHE.get(cache_key)
+  if cached is not None and now - cached[0] < SERVICE_CACHE_TTL:
+    return cached[1]
 
-  return DiscoveryDocument.build(CALENDAR_API_NAME,
-                                 CALENDAR_API_VERSION,
-                                 credentials,
-                                 developerKey=SECRET_KEY['DEVELOPER_KEY'])
+  service = DiscoveryDocument.build(CALENDAR_API_NAME,
+                                    CALENDAR_API_VERSION,
+                                    credentials,
+                                    developerKey=GetDeveloperKey())
+
+  with SERVICE_CACHE_LOCK:
+    SERVICE_CACHE[cache_key] = (now, service)
+
+  return service
 
 
 def RetrieveDiscoveryDoc(serviceName, version, credentials=None,
@@ -157,8 +427,7 @@ def RetrieveDiscoveryDoc(serviceName, version, credentials=None,
 
   if credentials is None:
     credentials = InitCredentials()
-  http = httplib2.Http()
-  http = credentials.authorize(http)
+  http = AuthorizedHttp(credentials)
 
   resp, content = http.request(requested_url)
 
@@ -174,32 +443,140 @@ def RetrieveDiscoveryDoc(serviceName, version, credentials=None,
   return content
 
 
+def ErrorReason(exc):
+  """Gets the reason given in the body of an API error response.
+
+  Args:
+    exc: An apiclient.errors.HttpError.
+
+  Returns:
+    The reason string (e.g. rateLimitExceeded) of the first error in the
+        response body, or None if it can't be determined.
+  """
+  try:
+    return json.loads(exc.content)['error']['errors'][0]['reason']
+  except (ValueError, KeyError, IndexError, TypeError):
+    return None
+
+
+def ErrorStatus(exc):
+  """Gets the HTTP status of a failed API request.
+
+  Args:
+    exc: An httplib2.HttpLib2Error or apiclient.errors.HttpError, or None.
+
+  Returns:
+    The integer status of the error response, or None if there was no response
+        (e.g. a transport error) or no error.
+  """
+  if not isinstance(exc, HttpError):
+    return None
+  return exc.resp.status
+
+
+def IsRetryable(exc):
+  """Determines if a failed API request should be retried.
+
+  Transport errors, server errors (5xx) and rate limit errors (403 or 429 with
+  a rate limit reason) are retryable. Any other error (e.g. a 404 or a 400 for
+  a malformed body) will fail again, so it is not retried.
+
+  Args:
+    exc: An httplib2.HttpLib2Error or apiclient.errors.HttpError.
+
+  Returns:
+    Boolean indicating whether the request should be retried.
+  """
+  if not isinstance(exc, HttpError):
+    return True
+
+  status = exc.resp.status
+  if status >= 500 or status == 429:
+    return True
+  return status == 403 and ErrorReason(exc) in RATE_LIMIT_REASONS
+
+
+def BackoffDelay(attempt, exc=None):
+  """Computes how long to wait before retrying a failed API request.
+
+  Honors a Retry-After header on the error response. Otherwise uses an
+  exponential backoff with random jitter so that concurrent tasks don't
+  retry in lockstep.
+
+  Args:
+    attempt: The number of attempts which have failed so far (at least 1).
+    exc: The (optional) error from the last failed attempt.
+
+  Returns:
+    The delay in seconds as a float.
+  """
+  if isinstance(exc, HttpError):
+    try:
+      return float(exc.resp['retry-after'])
+    except (KeyError, ValueError):
+      pass
+
+  backoff = BACKOFF_BASE * 2 ** (attempt - 1)
+  return backoff + random.uniform(0, backoff)
+
+
+def Backoff(delay, results=None):
+  """Sleeps for a short delay, or raises RetryLater for a long one.
+
+  Args:
+    delay: The number of seconds to wait.
+    results: An optional list of results to attach to the RetryLater error.
+
+  Raises:
+    RetryLater in the case that {delay} exceeds BACKOFF_MAX_SLEEP, so that the
+        request thread is not held while sleeping
+  """
+  if delay > BACKOFF_MAX_SLEEP:
+    raise RetryLater(delay, results=results)
+  time.sleep(delay)
+
+
 def AttemptAPIAction(http_verb, num_attempts=3, log_msg=None,
-                     credentials=None, **kwargs):
+                     credentials=None, reraise_statuses=(), **kwargs):
   """Attempt an API action a predetermined number of times before failing.
 
+  Each attempt first acquires quota from the shared API budget. Retryable
+  errors (see IsRetryable) are retried with exponential backoff; any other
+  error fails the request immediately.
+
   Args:
     http_verb: The HTTP verb of the intended request. Examle: get, update.
     num_attempts: The number of attempts to make before failing the request.
         Defaults to 3.
     log_msg: The log message to report upon success. Defaults to None.
     credentials: An OAuth2Credentials object used to build a service object.
+    reraise_statuses: HTTP statuses for which an HttpError is raised to the
+        caller instead of failing the request. Defaults to none.
     kwargs: The keyword arguments to be passed to the API request.
 
   Returns:
     The result of the API request
+
+  Raises:
+    HttpError in the case that the response has a status in
+        {reraise_statuses}
+    RetryLater in the case that the backoff before the next attempt (or the
+        wait for API quota) is too long to wait out in the current request
   """
+  credentials = ResolveCredentials(credentials)
   service = InitService(credentials=credentials)
 
   # pylint:disable-msg=E1101
   api_action = getattr(service.events(), http_verb, None)
   if api_action is None:
     return None
+  http = AuthorizedHttp(credentials)
 
   attempts = int(num_attempts) if int(num_attempts) > 0 else 0
-  while attempts:
+  for attempt in xrange(1, attempts + 1):
+    AcquireAPIQuota()
     try:
-      result = api_action(**kwargs).execute()
+      result = api_action(**kwargs).execute(http=http)
 
       if log_msg is None:
         log_msg = '{id_} changed via {verb}'.format(id_=result['id'],
@@ -209,7 +586,202 @@ def AttemptAPIAction(http_verb, num_attempts=3, log_msg=None,
       return result
     except (httplib2.HttpLib2Error, HttpError) as exc:
       logging.info(exc)
-      attempts -= 1
-      time.sleep(3)
+      if isinstance(exc, HttpError) and exc.resp.status in reraise_statuses:
+        raise
+      if not IsRetryable(exc) or attempt == attempts:
+        break
+      Backoff(BackoffDelay(attempt, exc))
 
   return None
+
+
+def ExecuteBatch(service, requests, indices, results, errors, http=None):
+  """Executes a subset of API requests as a single batch request.
+
+  Args:
+    service: A Resource object for the calendar API.
+    requests: A list of pairs (http_verb, kwargs) as in AttemptBatchAPIAction.
+    indices: The indices within {requests} to be sent in this batch. At most
+        BATCH_SIZE indices should be passed.
+    results: A list of the same length as {requests}. The result of each
+        successful sub-request is stored at the index of its request.
+    errors: A list of the same length as {requests}. Once the batch is sent,
+        the error of each sub-request is stored at the index of its request,
+        or None if it succeeded (or its outcome is not known).
+    http: The httplib2.Http to send the batch with. Defaults to None, in which
+        case the Http of {service} is used.
+
+  Raises:
+    RetryLater in the case that API quota can't be acquired for the batch.
+        The batch is not sent, so {errors} is left as it was.
+  """
+
+  def Callback(request_id, response, exception):
+    """Maps a sub-response back to the index of the request it belongs to."""
+    index = int(request_id)
+    if exception is not None:
+      logging.info(exception)
+      errors[index] = exception
+      return
+
+    http_verb, kwargs = requests[index]
+    id_ = kwargs.get('eventId') or response['id']
+    logging.info('{id_} changed via {verb} in batch'.format(id_=id_,
+                                                            verb=http_verb))
+    results[index] = response
+
+  batch = BatchHttpRequest(callback=Callback)
+  events = service.events()  # pylint:disable-msg=E1101
+  for index in indices:
+    http_verb, kwargs = requests[index]
+    batch.add(getattr(events, http_verb)(**kwargs), request_id=str(index))
+
+  AcquireAPIQuota(num_calls=len(indices))
+  for index in indices:
+    errors[index] = None
+  try:
+    batch.execute(http=http)
+  except (httplib2.HttpLib2Error, HttpError) as exc:
+    logging.info(exc)
+    for index in indices:
+      if results[index] is None:
+        errors[index] = exc
+
+
+def ExecuteBatches(requests, chunks, results, errors, max_concurrency,
+                   credentials=None):
+  """Executes batch requests concurrently on a bounded number of threads.
+
+  The threads share the cached service object, but each sends its batches
+  with an Http of its own taken from the worker pool (see CheckoutHttp),
+  since an Http is not thread-safe.
+
+  Args:
+    requests: A list of pairs (http_verb, kwargs) as in AttemptBatchAPIAction.
+    chunks: A list of lists of indices within {requests}, each to be sent as
+        a single batch request (see ExecuteBatch).
+    results: A list of the same length as {requests}. The result of each
+        successful sub-request is stored at the index of its request.
+    errors: A list of the same length as {requests}, filled in as by
+        ExecuteBatch for the batches which are sent.
+    max_concurrency: The maximum number of batch requests in flight at once.
+    credentials: An OAuth2Credentials object used to build a service object.
+
+  Raises:
+    RetryLater in the case that API quota can't be acquired for a batch; the
+        longest delay of any batch is used. Any other error raised by a batch
+        is raised again once every thread has finished. Either way {results}
+        is attached to the error as its results attribute, so the work of the
+        batches which did complete can still be recorded.
+  """
+  chunk_queue = Queue.Queue()
+  for indices in chunks:
+    chunk_queue.put(indices)
+
+  worker_errors = []
+
+  def Worker():
+    """Sends batches from the queue until it is empty or a batch errors."""
+    checked_out = None
+    try:
+      service = InitService(credentials=credentials)
+      checked_out = CheckoutHttp(credentials)
+      http = checked_out[1]
+      while True:
+        try:
+          indices = chunk_queue.get_nowait()
+        except Queue.Empty:
+          return
+        ExecuteBatch(service, requests, indices, results, errors, http=http)
+    except Exception as exc:  # pylint:disable-msg=W0703
+      worker_errors.append(exc)
+    finally:
+      CheckinHttp(checked_out)
+
+  num_threads = min(max_concurrency, len(chunks))
+  if num_threads <= 1:
+    Worker()
+  else:
+    threads = [threading.Thread(target=Worker) for _ in xrange(num_threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  if not worker_errors:
+    return
+
+  failures = [exc for exc in worker_errors if not isinstance(exc, RetryLater)]
+  if failures:
+    error = failures[0]
+  else:
+    error = max(worker_errors, key=lambda exc: exc.delay)
+  error.results = results
+  raise error
+
+
+def AttemptBatchAPIAction(requests, num_attempts=3, credentials=None,
+                          max_concurrency=MAX_CONCURRENT_BATCHES, errors=None):
+  """Attempt a list of API actions using batch requests.
+
+  The requests are sent in batch requests of at most BATCH_SIZE calls, with
+  up to {max_concurrency} batch requests in flight at once. The sub-requests
+  that fail with a retryable error (see IsRetryable) are sent again in new
+  batches, after backing off, until {num_attempts} rounds have been made.
+
+  Args:
+    requests: A list of pairs (http_verb, kwargs) where http_verb is the HTTP
+        verb of the intended request (e.g. insert, update) and kwargs are the
+        keyword arguments to be passed to the API request.
+    num_attempts: The number of attempts to make before failing a request.
+        Defaults to 3.
+    credentials: An OAuth2Credentials object used to build a service object.
+    max_concurrency: The maximum number of batch requests in flight at once.
+        Defaults to MAX_CONCURRENT_BATCHES.
+    errors: An optional list of the same length as {requests}. The error of
+        the last attempt of each request which failed is stored at the index
+        of its request, e.g. so the caller can tell a 404 from an outage, and
+        None for each request which succeeded. The entry stays NOT_SENT for
+        each request which was never sent, e.g. for lack of API quota.
+
+  Returns:
+    A list of the results of the API requests in the same order as
+        {requests}. The result is None for each request which failed.
+
+  Raises:
+    RetryLater in the case that the backoff before the next round (or the
+        wait for API quota) is too long to wait out in the current request.
+        The results so far are attached to the error (as they are to any
+        other error raised by a batch) so that completed work can still be
+        recorded.
+  """
+  results = [None] * len(requests)
+  if errors is None:
+    errors = [None] * len(requests)
+  errors[:] = [NOT_SENT] * len(requests)
+  if not requests:
+    return results
+
+  credentials = ResolveCredentials(credentials)
+  service = InitService(credentials=credentials)
+  events = service.events()  # pylint:disable-msg=E1101
+  pending = [index for index, (http_verb, _) in enumerate(requests)
+             if getattr(events, http_verb, None) is not None]
+
+  attempts = int(num_attempts) if int(num_attempts) > 0 else 0
+  for attempt in xrange(1, attempts + 1):
+    chunks = [pending[start:start + BATCH_SIZE]
+              for start in xrange(0, len(pending), BATCH_SIZE)]
+    ExecuteBatches(requests, chunks, results, errors, max_concurrency,
+                   credentials=credentials)
+
+    retryable = [index for index in pending
+                 if results[index] is None and IsRetryable(errors[index])]
+    if not retryable or attempt == attempts:
+      break
+
+    pending = retryable
+    Backoff(max(BackoffDelay(attempt, errors[index]) for index in retryable),
+            results=results)
+
+  return results
@@ -26,11 +26,13 @@ import datetime
 import json
 import logging
 import re
+import time
 
 # Third-party libraries
 from icalendar import Calendar
 
 # App engine specific libraries
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.api import urlfetch_errors
 from google.appengine.ext import ndb
@@ -38,13 +40,43 @@ from google.appengine import runtime
 
 # App specific libraries
 from custom_exceptions import BadInterval
+from custom_exceptions import OutOfTime
+from custom_exceptions import RetryLater
+from google_api_utils import AttemptBatchAPIAction
+from google_api_utils import BATCH_SIZE
+from google_api_utils import ErrorStatus
+from google_api_utils import MAX_CONCURRENT_BATCHES
+from google_api_utils import NOT_SENT
 from handler_utils import DeferFunctionDecorator
 from handler_utils import EmailAdmins
 from models import Event
+from models import MAX_WRITE_ATTEMPTS
+from models import Membership
+from models import PendingWrite
+from models import RecordEventStateAsync
+from models import RecordFeedFinished
+from models import RecordWriteResultAsync
+from models import SyncCheckpoint
+from sync_plan import EXECUTE_BATCH_SIZE
+from sync_plan import ExecutePlan
+from sync_plan import PlanEvents
+from sync_plan import PlanRemovals
 import time_utils
 
 
-CALENDAR_ID = 'vhoam1gb7uqqoqevu91liidi80@group.calendar.google.com'
+DRAIN_PAGE_SIZE = BATCH_SIZE * MAX_CONCURRENT_BATCHES
+DRAIN_SCHEDULED = {}
+# Changes recorded during a window are sent to GCal at the end of it
+DRAIN_WINDOW = 10 * 60  # seconds
+MEMBERSHIP_BATCH_SIZE = 100
+PLAN_CHUNK_SIZE = 100
+# Syncs which haven't finished after this long are abandoned
+SYNC_CHECKPOINT_MAX_AGE = datetime.timedelta(days=2)
+# A VEVENT block of a feed, and the date its DTEND line starts with
+VEVENT_PATTERN = re.compile(r'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?$\n?',
+                            re.DOTALL | re.MULTILINE)
+DTEND_PATTERN = re.compile(r'^DTEND(;[^:\r\n]*)?:(?P<date>\d{8})',
+                           re.MULTILINE)
 RESPONSES = {1: ['once a week', 'week'],
              4: ['every two days', 'two-day'],
              7: ['once a day', 'day'],
@@ -113,7 +145,10 @@ def WhiteList(link):
 def MonthlyCleanup(relative_date):
   """Deletes events older than three months.
 
-  Will delete events from the datastore that are older than three months. First
+  Will delete events that are older than three months, by recording them as
+  having no attendees left; the deletes are written behind to GCal and the
+  datastore by DrainPendingWrites. Also deletes the checkpoints of syncs
+  started more than SYNC_CHECKPOINT_MAX_AGE ago, which were abandoned. First
   checks that the date provided is at most two days prior to the current one.
 
   NOTE: This would seem to argue that relative_date should not be provided, but
@@ -126,18 +161,7 @@ def MonthlyCleanup(relative_date):
   Args:
     relative_date: date provided by calling script. Expected to be current date.
   """
-  prior_date_day = relative_date.day
-
-  prior_date_month = relative_date.month - 3
-  if prior_date_month < 1:
-    prior_date_year = relative_date.year - 1
-    prior_date_month += 12
-  else:
-    prior_date_year = relative_date.year
-
-  prior_date = datetime.date(year=prior_date_year,
-                             month=prior_date_month,
-                             day=prior_date_day)
+  prior_date = time_utils.RetentionHorizon(relative_date)
 
   today = datetime.date.today()
   if today - relative_date > datetime.timedelta(days=2):
@@ -149,126 +173,247 @@ def MonthlyCleanup(relative_date):
 
   prior_date_as_str = time_utils.FormatTime(prior_date)
   old_events = Event.query(Event.end_date <= prior_date_as_str)
+  # Removing every attendee leaves the delete to DrainPendingWrites, which
+  # deletes the stored event once GCal is up to date (or at once if the
+  # event was never sent to GCal)
+  changed = False
+  futures = []
   for event in old_events:
-    event.delete()
+    futures.append(RecordEventStateAsync(event, removed=list(event.attendees)))
+    if len(futures) >= EXECUTE_BATCH_SIZE:
+      changed = any([future.get_result() for future in futures]) or changed
+      futures = []
+
+  if any([future.get_result() for future in futures]) or changed:
+    ScheduleDrain()
+
+  old_memberships = Membership.query(Membership.end <= prior_date_as_str)
+  ndb.delete_multi(old_memberships.iter(keys_only=True))
+
+  abandoned_before = datetime.datetime.utcnow() - SYNC_CHECKPOINT_MAX_AGE
+  for checkpoint in SyncCheckpoint.query(
+      SyncCheckpoint.started < abandoned_before):
+    ndb.delete_multi([checkpoint.key] + checkpoint.feed_keys())
 
 
 @DeferFunctionDecorator
-def UpdateUpcoming(user_cal, upcoming, credentials=None):
+def UpdateUpcoming(checkpoint_key, credentials=None):
   """Updates the GCal inst. by deleting events removed from extern. calendar.
 
-  If the new upcoming events list is different from that on the user_cal, it
-  will iterate through the difference and address events that no longer belong.
-  Such events would have been previously marked as upcoming (and stored in
-  UserCal.upcoming) and would not have occurred by the time UpdateUpcoming was
-  called. For such events, the user will be removed from the list of attendees.
-  If there are other remaining users, the event will be updated, else it will be
-  deleted from both the datastore and GCal.
+  Run once every feed of a sync has finished, and does nothing otherwise. If
+  the upcoming events recorded on the feed checkpoints differ from those on
+  the user_cal, it will iterate through the difference and address events
+  that no longer belong. Such events would have been previously marked as
+  upcoming (and stored in UserCal.upcoming or as a Membership) and would not
+  have occurred by the time UpdateUpcoming was called. For such events, the
+  user will be removed from the list of attendees. If there are other
+  remaining users, the event will be updated, else it will be deleted from
+  both the datastore and GCal. The changes are planned with PlanRemovals and
+  written behind to GCal by DrainPendingWrites. The checkpoints are deleted
+  once the user_cal is up to date, or straight away if a later sync of the
+  user has been started.
 
   Args:
-    user_cal: a UserCal object that will have upcoming events updated
-    upcoming: a list of UID strings representing events in the subscribed feeds
-        of the user that have not occurred yet (i.e. they are upcoming)
+    checkpoint_key: an ndb.Key for the SyncCheckpoint of a finished sync
     credentials: An OAuth2Credentials object used to build a service object.
         In the case the credentials is the default value of None, future
         methods will attempt to get credentials from the default credentials.
   """
-  upcoming.sort()
-  if user_cal.upcoming != upcoming:
+  checkpoint = checkpoint_key.get()
+  if checkpoint is None:
+    logging.info('Sync checkpoint {!r} already finished'.format(checkpoint_key))
+    return
+
+  feed_keys = checkpoint.feed_keys()
+  if checkpoint.superseded():
+    # A later sync of the user has a more recent view of the feeds
+    logging.info('Sync checkpoint {!r} superseded'.format(checkpoint_key))
+    ndb.delete_multi([checkpoint_key] + feed_keys)
+    return
+
+  user_cal = checkpoint.user_cal_key.get()
+  if user_cal is None:
+    ndb.delete_multi([checkpoint_key] + feed_keys)
+    return
+
+  feeds = ndb.get_multi(feed_keys)
+  finished = (sorted(checkpoint.finished) == range(len(feed_keys)) and
+              all(feed is not None and feed.done for feed in feeds))
+  if not finished:
+    logging.info('Sync checkpoint {!r} has unfinished feeds'.format(
+        checkpoint_key))
+    return
+
+  upcoming = set()
+  for feed in feeds:
+    upcoming.update(feed.upcoming)
+  upcoming = sorted(upcoming)
+
+  dry_run = checkpoint.dry_run
+  previous = set(user_cal.upcoming).union(
+      Membership.upcoming_uids(user_cal.key))
+  # Set difference rather than repeated list membership; both lists may
+  # hold thousands of UIDs for long-time users.
+  removed = sorted(previous.difference(upcoming))
+  if removed or list(user_cal.upcoming) != upcoming:
+    removed_events = ndb.get_multi([ndb.Key(Event, uid) for uid in removed])
+
     now = datetime.datetime.utcnow()
-    for uid in user_cal.upcoming:
-      if uid not in upcoming:
-        event = ndb.Key(Event, uid).get()
-        if event.end.to_datetime() > now:  # pylint:disable-msg=E1103
-          # If federated identity not set, User.__cmp__ only uses email
-          event.attendees.remove(user_cal.owner)  # pylint:disable-msg=E1103
-          if not event.attendees:  # pylint:disable-msg=E1103
-            event.delete(credentials=credentials)  # pylint:disable-msg=E1103
-          else:
-            event.update(credentials=credentials)  # pylint:disable-msg=E1103
+    # The event may have already been removed, e.g. by MonthlyCleanup
+    removed_events = [event for event in removed_events
+                      if event is not None and event.end.to_datetime() > now]
 
-    user_cal.upcoming = upcoming
-    user_cal.put()
+    plan = PlanRemovals(removed_events, user_cal.owner)
+    if ExecutePlan(plan, dry_run=dry_run):
+      ScheduleDrain(credentials=credentials)
+
+    if not dry_run:
+      ndb.delete_multi([ndb.Key(Membership, uid, parent=user_cal.key)
+                        for uid in removed])
+
+      user_cal.upcoming = upcoming
+      user_cal.put()
+
+  ndb.delete_multi([checkpoint_key] + feed_keys)
 
 
-# pylint:disable-msg=R0913
 @DeferFunctionDecorator
-def UpdateUserSubscriptions(user_cal, credentials=None, links=None,
-                            link_index=0, upcoming=None, last_used_uid=None):
-  """Updates a list of calendar subscriptions for a user.
+def UpdateUserSubscriptions(user_cal, credentials=None, dry_run=False):
+  """Starts a sync of the calendar subscriptions for a user.
 
-  Loops through each subscription URL in links (or user_cal.calendars) and calls
-  UpdateSubscription for each URL. Keeps a list of upcoming events which will
-  be updated by UpdateUpcoming upon completion. If the application encounters
-  one of the two DeadlineExceededError's while the events are being processed,
-  the function calls itself, but uses the upcoming, link_index and
-  last_used_uid keyword arguments to save the current processing state.
+  Stores a new SyncCheckpoint for the user and fans out one UpdateUserFeed
+  task per subscribed feed, so the feeds sync in parallel and a large feed
+  does not hold up the others. The last feed task to finish runs
+  UpdateUpcoming.
 
   Args:
     user_cal: a UserCal object that will have upcoming subscriptions updated
     credentials: An OAuth2Credentials object used to build a service object.
         In the case the credentials is the default value of None, future
         methods will attempt to get credentials from the default credentials.
-    links: a list of URLs to the .ics subscription feeds. This is None by
-        default, in which case user_cal.calendars is used.
-    link_index: a placeholder index within the list of links which is 0 by
-        default. This is intended to be passed in only by calls from
-        UpdateUserSubscriptions.
-    upcoming: a list of UID strings representing events in the subscribed feeds
-        of the user that have not occurred yet (i.e. they are upcoming). By
-        default this value is None and transformed to [] within the function.
-    last_used_uid: a placeholder UID which is None by default. This is intended
-        to be passed in only by calls from UpdateUserSubscriptions. In the case
-        it is not None, it will serve as a starting index within the set of UIDs
-        from the first subscription (first element of links) that is updated.
+    dry_run: If True, the sync is planned and the plans logged, but neither
+        the events, the memberships nor GCal are written to. Only the sync
+        checkpoints are stored, under their own sync ID, and they never
+        supersede a live sync. Defaults to False.
   """
-  if links is None:
-    links = user_cal.calendars
+  checkpoint = SyncCheckpoint.start(user_cal, dry_run=dry_run)
+  feed_keys = checkpoint.feed_keys()
+  if not feed_keys:
+    # pylint:disable-msg=E1123
+    UpdateUpcoming(checkpoint.key, credentials=credentials, defer_now=True)
+    return
 
-  if link_index > 0:
-    links = links[link_index:]
-  upcoming = upcoming or []
+  for feed_key in feed_keys:
+    # pylint:disable-msg=E1123
+    UpdateUserFeed(feed_key, credentials=credentials, defer_now=True)
 
-  # Set default values for link index and last used uid variables. These
-  # are used to to pick up where the loop left off in case the task encounters
-  # one of the DeadlineExceededError's.
-  index = 0
-  uid = None
 
-  try:
-    for index, link in enumerate(links):
-      # In the case last_used_uid is not None, we may be picking up in the
-      # middle of the feed for the first link in {links}
-      if index == 0 and last_used_uid is not None:
-        uid_generator = UpdateSubscription(link, user_cal.owner,
-                                           credentials=credentials,
-                                           start_uid=last_used_uid)
-      else:
-        uid_generator = UpdateSubscription(link, user_cal.owner,
-                                           credentials=credentials)
-
-      for uid, is_upcoming, failed in uid_generator:
+def SaveSyncProgress(feed, memberships, upcoming):
+  """Records memberships and then the checkpoint they were found up to.
+
+  Args:
+    feed: a FeedCheckpoint with last_used_uid set to the position reached in
+        the feed
+    memberships: a list of Membership objects found since the last save
+    upcoming: a set of UID strings of the upcoming events found so far
+  """
+  if not feed.dry_run:
+    Membership.record(memberships)
+  feed.upcoming = upcoming
+  feed.put()
+
+
+@DeferFunctionDecorator
+def UpdateUserFeed(feed_key, credentials=None):
+  """Updates one of the calendar subscriptions of a user from a checkpoint.
+
+  Calls UpdateSubscription for the feed, starting after the UID recorded on
+  the FeedCheckpoint. Records a Membership for each event in the feed and
+  accumulates the upcoming events on the checkpoint. The checkpoint is saved
+  along with each batch of memberships. Once the feed is done, the feed is
+  recorded as finished and, if it was the last feed of the sync to finish,
+  UpdateUpcoming is deferred in the same transaction. A feed is recorded as
+  finished without being synced if a later sync of the user has started or
+  the user is gone, so UpdateUpcoming can clean up the checkpoints.
+
+  The task has a TimeBudget which UpdateSubscription checks between chunks of
+  events. Once it is used up, the checkpoint is saved and the function calls
+  itself with only the checkpoint key. The same is done as a last resort if
+  the application encounters one of the two DeadlineExceededError's. Resumed
+  tasks use the default credentials.
+
+  Args:
+    feed_key: an ndb.Key for the FeedCheckpoint of the feed
+    credentials: An OAuth2Credentials object used to build a service object.
+        In the case the credentials is the default value of None, future
+        methods will attempt to get credentials from the default credentials.
+  """
+  feed = feed_key.get()
+  if feed is None:
+    logging.info('Feed checkpoint {!r} already finished'.format(feed_key))
+    return
+
+  user_cal = None
+  if not feed.done:
+    if feed.superseded():
+      # The upcoming events of this feed would never be used
+      logging.info('Feed checkpoint {!r} superseded'.format(feed_key))
+    else:
+      user_cal = feed.user_cal_key.get()
+      if user_cal is None:
+        logging.info('No UserCal for feed checkpoint {!r}'.format(feed_key))
+
+  if user_cal is not None:
+    budget = time_utils.TimeBudget()
+    upcoming = set(feed.upcoming)
+    memberships = []
+
+    try:
+      # In the case last_used_uid is not None, we are picking up in the middle
+      # of the feed, just after the event with that UID
+      uid_generator = UpdateSubscription(feed.link, user_cal.owner,
+                                         credentials=credentials,
+                                         start_uid=feed.last_used_uid,
+                                         dry_run=feed.dry_run, budget=budget)
+
+      for uid, end, is_upcoming in uid_generator:
+        if not feed.dry_run:
+          memberships.append(Membership(parent=user_cal.key, id=uid,
+                                        feed=feed.link, end=end))
+
         if is_upcoming:
-          upcoming.append(uid)
-        elif failed:
-          msg = 'silently failed operation on {uid} from {link}'.format(
-              uid=uid, link=link)
-          logging.info(msg)
-          EmailAdmins(msg, defer_now=True)  # pylint:disable-msg=E1123
-  except (runtime.DeadlineExceededError, urlfetch_errors.DeadlineExceededError):
-    # NOTE: upcoming has possibly been updated inside the try statement
+          upcoming.add(uid)
+
+        feed.last_used_uid = uid
+        if len(memberships) >= MEMBERSHIP_BATCH_SIZE:
+          SaveSyncProgress(feed, memberships, upcoming)
+          memberships = []
+    except OutOfTime:
+      logging.info('Saving {!r} with {!r}'.format(feed_key, budget))
+      SaveSyncProgress(feed, memberships, upcoming)
+      UpdateUserFeed(feed_key, defer_now=True)  # pylint:disable-msg=E1123
+      return
+    except (runtime.DeadlineExceededError,
+            urlfetch_errors.DeadlineExceededError):
+      SaveSyncProgress(feed, memberships, upcoming)
+      UpdateUserFeed(feed_key, defer_now=True)  # pylint:disable-msg=E1123
+      return
+
+    SaveSyncProgress(feed, memberships, upcoming)
+
+  def ScheduleUpcoming():
+    """Enqueues UpdateUpcoming along with recording the last feed finished."""
     # pylint:disable-msg=E1123
-    UpdateUserSubscriptions(user_cal, credentials=credentials, links=links,
-                            link_index=index, upcoming=upcoming,
-                            last_used_uid=uid, defer_now=True)
-    return
+    UpdateUpcoming(feed.checkpoint_key, credentials=credentials,
+                   defer_now=True, _transactional=True)
 
-  # If the loop completes without timing out
-  # pylint:disable-msg=E1123
-  UpdateUpcoming(user_cal, upcoming, credentials=credentials, defer_now=True)
+  # If the feed completes without timing out
+  RecordFeedFinished(feed_key, ScheduleUpcoming)
 
 
-def UpdateSubscription(link, current_user, credentials=None, start_uid=None):
+# pylint:disable-msg=R0913
+def UpdateSubscription(link, current_user, credentials=None, start_uid=None,
+                       dry_run=False, horizon=None, budget=None):
   """Updates the GCal instance with the events in link for the current_user.
 
   Args:
@@ -278,16 +423,28 @@ def UpdateSubscription(link, current_user, credentials=None, start_uid=None):
         In the case the credentials is the default value of None, future
         methods will attempt to get credentials from the default credentials.
     start_uid: a placeholder UID which is None by default. This is intended
-        to be passed in only by calls from UpdateUserSubscriptions. In the case
-        it is not None, it will serve as a starting index within the set of
-        event UIDs from {link}.
+        to be passed in only by calls from UpdateUserFeed. In the case
+        it is not None, the events in {link} up to and including the one with
+        this UID are skipped, since they were synced by an earlier task.
+    dry_run: If True, the plans are logged but not executed. Defaults to
+        False.
+    horizon: a datetime.date; events in {link} ending before it are skipped
+        (see FilterPastEvents). Defaults to the retention horizon used by
+        MonthlyCleanup.
+    budget: an optional time_utils.TimeBudget, checked before the feed is
+        fetched and before each chunk of events is synced.
 
   Returns:
-    A generator instance which yields tuples (uid, is_upcoming, failed) tuples
-        where uid is the id of an event, is_upcoming is a boolean that is True
-        if and only if the event has not occurred yet (i.e. is upcoming) and
-        failed is a boolean that is True if and only if the three attempts to
-        add or update the event fail.
+    A generator instance which yields tuples (uid, end, is_upcoming) where
+        uid is the id of an event, end is the string value of the end time of
+        the event and is_upcoming is a boolean that is True if and only if the
+        event has not occurred yet (i.e. is upcoming). Changes are written
+        behind to GCal (see DrainPendingWrites), which reports writes that
+        can't be made.
+
+  Raises:
+    OutOfTime in the case that {budget} is used up. Every event yielded
+        before this has been synced.
   """
   logging.info('UpdateSubscription called with: {!r}'.format(locals()))
 
@@ -297,6 +454,7 @@ def UpdateSubscription(link, current_user, credentials=None, start_uid=None):
     # http://www.python.org/dev/peps/pep-0255/ (Specification: Return)
     return
 
+  CheckBudget(budget)
   now = datetime.datetime.utcnow()
 
   import_feed = urlfetch.fetch(link, deadline=60)
@@ -309,15 +467,24 @@ def UpdateSubscription(link, current_user, credentials=None, start_uid=None):
     EmailAdmins(error_msg, defer_now=True)  # pylint:disable-msg=E1123
     return
 
-  ical = Calendar.from_ical(import_feed.content)
+  if horizon is None:
+    horizon = time_utils.RetentionHorizon(now.date())
+  content, num_skipped = FilterPastEvents(import_feed.content, horizon)
+  logging.info('Skipped {:d} events in {} ending before {}'.format(
+      num_skipped, link, horizon))
+
+  ical = Calendar.from_ical(content)
 
   start_index = 0
   if start_uid is not None:
     # pylint:disable-msg=E1103
     uid_list = [component.get('uid', '') for component in ical.walk()]
     if start_uid in uid_list:
-      start_index = uid_list.index(start_uid)
+      start_index = uid_list.index(start_uid) + 1
 
+  # Events are planned and the plans executed in chunks of PLAN_CHUNK_SIZE;
+  # results are yielded in feed order once a chunk has been executed
+  chunk = []
   for component in ical.walk()[start_index:]:  # pylint:disable-msg=E1103
     if component.name != 'VEVENT':
       msg = ('iCal at {link} has unexpected event type '
@@ -325,13 +492,252 @@ def UpdateSubscription(link, current_user, credentials=None, start_uid=None):
       logging.info(msg)
       if component.name != 'VCALENDAR':
         EmailAdmins(msg, defer_now=True)  # pylint:disable-msg=E1123
-    else:
-      event, failed = Event.from_ical_event(component, current_user,
-                                            credentials=credentials)
-
-      uid = event.key.id()
-      if failed:
-        yield (uid, False, True)
-      else:
-        is_upcoming = event.end.to_datetime() > now
-        yield (uid, is_upcoming, False)
+      continue
+
+    chunk.append(component)
+    if len(chunk) >= PLAN_CHUNK_SIZE:
+      CheckBudget(budget)
+      for result in SyncChunk(chunk, current_user, now,
+                              credentials=credentials, dry_run=dry_run):
+        yield result
+      chunk = []
+
+  if chunk:
+    CheckBudget(budget)
+  for result in SyncChunk(chunk, current_user, now, credentials=credentials,
+                          dry_run=dry_run):
+    yield result
+
+
+def CheckBudget(budget):
+  """Stops the work of a task if its time budget is used up.
+
+  Args:
+    budget: a time_utils.TimeBudget, or None if the task has no budget.
+
+  Raises:
+    OutOfTime in the case that {budget} is used up.
+  """
+  if budget is not None and budget.exhausted():
+    raise OutOfTime(budget.remaining())
+
+
+def FilterPastEvents(content, horizon):
+  """Removes the events ending before a horizon from the text of a feed.
+
+  This is done on the raw text, before the feed is parsed, so events which
+  are long past cost neither parsing nor any datastore or API work. Only the
+  date in the DTEND line is read; events without one are kept.
+
+  Args:
+    content: The iCalendar text of a feed.
+    horizon: a datetime.date; events ending before it are removed.
+
+  Returns:
+    A pair (content, num_skipped) of the filtered text and the number of
+        events removed.
+  """
+  horizon_str = horizon.strftime('%Y%m%d')
+  skipped = []
+
+  def Replace(match):
+    """Drops a VEVENT block if it ends before the horizon."""
+    dtend = DTEND_PATTERN.search(match.group(0))
+    if dtend is not None and dtend.group('date') < horizon_str:
+      skipped.append(dtend.group('date'))
+      return ''
+    return match.group(0)
+
+  content = VEVENT_PATTERN.sub(Replace, content)
+  return content, len(skipped)
+
+
+def SyncChunk(ical_events, current_user, now, credentials=None, dry_run=False):
+  """Plans and executes the changes for a chunk of feed events.
+
+  Args:
+    ical_events: A list of icalendar.cal.Event objects, in feed order.
+    current_user: a User instance corresponding to the user that is updating
+    now: A datetime.datetime used to determine if an event is upcoming.
+    credentials: An OAuth2Credentials object used to build a service object.
+        In the case the credentials is the default value of None, future
+        methods will attempt to get credentials from the default credentials.
+    dry_run: If True, the plan is logged but not executed. Defaults to False.
+
+  Returns:
+    A list of tuples (uid, end, is_upcoming) as yielded by
+        UpdateSubscription, in feed order (one per UID).
+  """
+  plan = PlanEvents(ical_events, current_user)
+  if ExecutePlan(plan, dry_run=dry_run):
+    ScheduleDrain(credentials=credentials)
+
+  results = []
+  for event, _ in plan.entries.values():
+    is_upcoming = event.end.to_datetime() > now
+    results.append((event.key.id(), event.end.value, is_upcoming))
+
+  return results
+
+
+def ScheduleDrain(credentials=None):
+  """Schedules DrainPendingWrites at the end of the current drain window.
+
+  The task is named after the window, so changes recorded during a window are
+  drained by a single task however many sync tasks record them. Only one
+  attempt to add the task is made per window by each instance.
+
+  Args:
+    credentials: An OAuth2Credentials object used to build a service object.
+        In the case the credentials is the default value of None, future
+        methods will attempt to get credentials from the default credentials.
+  """
+  now = time.time()
+  window = int(now) // DRAIN_WINDOW
+  if DRAIN_SCHEDULED.get('WINDOW') == window:
+    return
+
+  task_name = 'drain-pending-writes-{:d}'.format(window)
+  countdown = (window + 1) * DRAIN_WINDOW - now
+  try:
+    # pylint:disable-msg=E1123
+    DrainPendingWrites(credentials=credentials, defer_now=True,
+                       _name=task_name, _countdown=countdown)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # already scheduled for this window
+  DRAIN_SCHEDULED['WINDOW'] = window
+
+
+@DeferFunctionDecorator
+def DrainPendingWrites(credentials=None, cursor=None):
+  """Sends the latest stored state of every pending event to GCal.
+
+  Pending writes are drained in pages of DRAIN_PAGE_SIZE, each page sent as
+  concurrent batch requests. The task has a TimeBudget which is checked
+  between pages; once it is used up, or when the API asks us to back off, the
+  task defers itself from the last finished page. The task can still be
+  stopped at any point (e.g. by a DeadlineExceededError, as a last resort): a
+  write is only cleared once its result is recorded, and inserts are sent
+  with an ID derived from the UID (see Event.gcal_event_id), so an insert
+  which is sent again can't create a second event. Writes which fail are
+  kept and drained again in the next window, until they are abandoned after
+  MAX_WRITE_ATTEMPTS (see RecordWriteResultAsync), in which case the admins
+  are emailed.
+
+  Args:
+    credentials: An OAuth2Credentials object used to build a service object.
+        In the case the credentials is the default value of None, future
+        methods will attempt to get credentials from the default credentials.
+    cursor: A urlsafe query cursor to resume the drain from. Intended to be
+        passed in only by calls from DrainPendingWrites.
+  """
+  start_cursor = None
+  if cursor is not None:
+    start_cursor = ndb.Cursor(urlsafe=cursor)
+
+  budget = time_utils.TimeBudget()
+  num_failed = 0
+  try:
+    more = True
+    while more:
+      CheckBudget(budget)
+      write_keys, next_cursor, more = PendingWrite.query().fetch_page(
+          DRAIN_PAGE_SIZE, start_cursor=start_cursor, keys_only=True)
+      num_failed += ApplyPendingWrites(write_keys, credentials=credentials)
+      start_cursor = next_cursor
+  except OutOfTime:
+    logging.info('Deferring drain with {!r}'.format(budget))
+    cursor = start_cursor.urlsafe() if start_cursor is not None else None
+    # pylint:disable-msg=E1123
+    DrainPendingWrites(credentials=credentials, cursor=cursor, defer_now=True)
+    return
+  except (runtime.DeadlineExceededError, urlfetch_errors.DeadlineExceededError):
+    cursor = start_cursor.urlsafe() if start_cursor is not None else None
+    # pylint:disable-msg=E1123
+    DrainPendingWrites(credentials=credentials, cursor=cursor, defer_now=True)
+    return
+  except RetryLater as exc:
+    cursor = start_cursor.urlsafe() if start_cursor is not None else None
+    # pylint:disable-msg=E1123
+    DrainPendingWrites(credentials=credentials, cursor=cursor, defer_now=True,
+                       _countdown=exc.delay)
+    return
+
+  if num_failed:
+    logging.info('{:d} pending writes failed, retrying next window'.format(
+        num_failed))
+    ScheduleDrain(credentials=credentials)
+
+
+def ApplyPendingWrites(write_keys, credentials=None):
+  """Sends the stored state of a page of pending events in batch requests.
+
+  Args:
+    write_keys: A list of ndb.Key's of PendingWrite entities.
+    credentials: An OAuth2Credentials object used to build a service object.
+
+  Returns:
+    The number of writes which failed and are kept for the next drain.
+
+  Raises:
+    RetryLater in the case that the API asked us to back off for longer than
+        can be waited out, or any other error raised while sending the
+        batches. The writes which were sent are still recorded before it is
+        raised, while those which were never sent are left as they were (so
+        they are not counted as failed attempts).
+  """
+  pending_writes = ndb.get_multi(write_keys)
+  events = ndb.get_multi([ndb.Key(Event, write_key.id())
+                          for write_key in write_keys])
+
+  planned = []
+  requests = []
+  for write_key, pending_write, event in zip(write_keys, pending_writes,
+                                             events):
+    if pending_write is None:
+      continue  # drained by an earlier attempt
+    action = None if event is None else event.pending_action()
+    planned.append((write_key, pending_write.version, action))
+    if action is not None:
+      requests.append(event.api_request(action))
+
+  failure = None
+  errors = [None] * len(requests)
+  try:
+    results = AttemptBatchAPIAction(requests, credentials=credentials,
+                                    errors=errors)
+  except Exception as exc:  # pylint:disable-msg=W0703
+    # The writes which did complete are recorded before raising it again
+    results = getattr(exc, 'results', None)
+    if results is None:
+      raise
+    failure = exc
+
+  results = iter(results)
+  errors = iter(errors)
+  recorded = []
+  futures = []
+  for write_key, version, action in planned:
+    result = status = None
+    if action is not None:
+      result = results.next()
+      error = errors.next()
+      if error is NOT_SENT:
+        continue  # left as it was, GCal never saw the write
+      status = ErrorStatus(error)
+    recorded.append(write_key)
+    futures.append(RecordWriteResultAsync(write_key, version, action, result,
+                                          status=status))
+
+  outcomes = [future.get_result() for future in futures]
+  abandoned = [write_key.id() for write_key, outcome
+               in zip(recorded, outcomes) if outcome == 'abandoned']
+  if abandoned:
+    msg = 'Abandoned writes to GCal after {:d} attempts: {}'.format(
+        MAX_WRITE_ATTEMPTS, ', '.join(abandoned))
+    logging.info(msg)
+    EmailAdmins(msg, defer_now=True)  # pylint:disable-msg=E1123
+
+  if failure is not None:
+    raise failure  # pylint:disable-msg=E0702
+  return outcomes.count('retry')
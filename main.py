@@ -73,7 +73,7 @@ class MainHandler(ExtendedHandler):
 
     # guaranteed to be a user since login_required
     current_user = users.get_current_user()
-    user_cal = ndb.Key(UserCal, current_user.user_id()).get()
+    user_cal = UserCal.get_cached(current_user.user_id())
     if user_cal is None:
       base_interval = ConvertToInterval(datetime.datetime.utcnow())
       user_cal = UserCal(key=ndb.Key(UserCal, current_user.user_id()),
@@ -215,7 +215,7 @@ class GetInfoHandler(ExtendedHandler):
       logging.info('no_user:fail')
       return
 
-    user_cal = ndb.Key(UserCal, current_user.user_id()).get()
+    user_cal = UserCal.get_cached(current_user.user_id())
     if user_cal is None:
       self.response.out.write(json.dumps('no_cal:fail'))
       logging.info('no_cal:fail')
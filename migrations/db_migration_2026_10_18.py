@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""DB migration for storing UserCal.upcoming as an unindexed blob.
+
+Intended to be run through the remote API:
+
+remote_api_shell.py -s persistent-cal.appspot.com
+
+s~persistent-cal> import os
+s~persistent-cal> import sys
+s~persistent-cal> sys.path.append('/path/to/persistent-cal')
+s~persistent-cal> # or sys.path.append(os.getcwd())
+s~persistent-cal> os.environ['HTTP_HOST'] = 'persistent-cal.appspot.com'
+s~persistent-cal> from db_migration_2026_10_18 import UpdateUserCals
+s~persistent-cal> UpdateUserCals()
+
+The migration imports the new models, so it runs after the new code is
+deployed. UserCal entities are read raw, since any UserCal put by the new
+code in the meantime already stores upcoming as a single blob; those are
+skipped. Only entities still holding a list of UIDs are rewritten.
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# App engine specific libraries
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+# App specific libraries
+import models
+
+
+BATCH_SIZE = 100
+
+
+def AsList(value):
+  """Returns a raw property value as a list of values."""
+  if value is None:
+    return []
+  if isinstance(value, list):
+    return value
+  return [value]
+
+
+def TransformUserCal(raw_entity):
+  """Takes a raw UserCal entity to the new specification.
+
+  Args:
+    raw_entity: A datastore.Entity of kind UserCal.
+
+  Returns:
+    A models.UserCal, or None if upcoming is already stored as a blob.
+  """
+  upcoming = raw_entity.get('upcoming')
+  if upcoming is not None and not isinstance(upcoming, list):
+    return None
+
+  return models.UserCal(key=ndb.Key(models.UserCal, raw_entity.key().name()),
+                        owner=raw_entity['owner'],
+                        calendars=AsList(raw_entity.get('calendars')),
+                        update_intervals=AsList(
+                            raw_entity.get('update_intervals')),
+                        upcoming=AsList(upcoming))
+
+
+def UpdateUserCals():
+  """Updates user calendars.
+
+  Returns:
+    A pair (rewritten, skipped) of the number of UserCal entities rewritten
+        and the number already stored in the new specification.
+  """
+  rewritten = skipped = 0
+  batch = []
+  for raw_entity in datastore.Query(models.UserCal._get_kind()).Run():
+    user_cal = TransformUserCal(raw_entity)
+    if user_cal is None:
+      skipped += 1
+      continue
+
+    rewritten += 1
+    batch.append(user_cal)
+    if len(batch) >= BATCH_SIZE:
+      ndb.put_multi(batch)
+      batch = []
+
+  if batch:
+    ndb.put_multi(batch)
+
+  return rewritten, skipped
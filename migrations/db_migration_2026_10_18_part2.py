@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""DB migration for rewriting Event and UserCal with the explicit index plan.
+
+Intended to be run through the remote API:
+
+remote_api_shell.py -s persistent-cal.appspot.com
+
+s~persistent-cal> import os
+s~persistent-cal> import sys
+s~persistent-cal> sys.path.append('/path/to/persistent-cal')
+s~persistent-cal> # or sys.path.append(os.getcwd())
+s~persistent-cal> os.environ['HTTP_HOST'] = 'persistent-cal.appspot.com'
+s~persistent-cal> from db_migration_2026_10_18_part2 import UpdateAll
+s~persistent-cal> UpdateAll()
+
+This must be run after db_migration_2026_10_18, which converts the stored
+UserCal.upcoming list.
+
+Each kind is read as raw entities so the index writes of the stored (before)
+entity can be compared with those of the rewritten (after) entity. Putting a
+new entity costs two writes for the entity and the kind index plus two (one
+ascending, one descending) for every indexed property value. For an Event with
+n attendees this goes from 2 + 2 * (9 + n) to 6, since only end_date and
+gcal_edit stay indexed; for a UserCal with k feeds and m update intervals it
+goes from 2 + 2 * (1 + k + m) to 2 + 2 * m.
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# App engine specific libraries
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+# App specific libraries
+import models
+
+
+BATCH_SIZE = 100
+
+
+def IndexWritesPerPut(entity_pb):
+  """Number of index writes needed to put an entity as a new entity.
+
+  Args:
+    entity_pb: An entity_pb.EntityProto for the entity being put.
+
+  Returns:
+    Integer count of writes, assuming only the built-in indexes.
+  """
+  return 2 + 2 * len(entity_pb.property_list())
+
+
+def RewriteKind(model_class):
+  """Rewrites every entity of a kind using the current model definition.
+
+  Args:
+    model_class: An ndb.Model subclass whose kind will be rewritten.
+
+  Returns:
+    A dictionary with the number of entities rewritten and the average index
+        writes per put before and after the rewrite.
+  """
+  adapter = ndb.ModelAdapter()
+  count = before = after = 0
+  batch = []
+  for raw_entity in datastore.Query(model_class._get_kind()).Run():
+    stored_pb = raw_entity.ToPb()
+    entity = adapter.pb_to_entity(stored_pb)
+
+    count += 1
+    before += IndexWritesPerPut(stored_pb)
+    after += IndexWritesPerPut(adapter.entity_to_pb(entity))
+
+    batch.append(entity)
+    if len(batch) >= BATCH_SIZE:
+      ndb.put_multi(batch)
+      batch = []
+
+  if batch:
+    ndb.put_multi(batch)
+
+  count_or_one = count or 1
+  return {'entities': count,
+          'before': before / float(count_or_one),
+          'after': after / float(count_or_one)}
+
+
+def UpdateAll():
+  """Rewrites Event and UserCal entities and reports index writes per put."""
+  report = {}
+  for model_class in (models.Event, models.UserCal):
+    kind = model_class._get_kind()
+    report[kind] = RewriteKind(model_class)
+    print '{kind}: {entities} entities, {before:.1f} -> {after:.1f}'.format(
+        kind=kind, **report[kind])
+
+  return report
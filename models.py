@@ -22,21 +22,104 @@ __author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
 
 
 # General libraries
+import base64
 import datetime
+import hashlib
 import logging
+import string
+import time
 
 # App engine specific libraries
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 # App specific libraries
 from custom_exceptions import InappropriateAPIAction
 from custom_exceptions import MissingUID
 from custom_exceptions import UnexpectedDescription
-from google_api_utils import AttemptAPIAction
 import time_utils
 
 
+# The original calendar, which holds every event inserted before sharding
 CALENDAR_ID = 'vhoam1gb7uqqoqevu91liidi80@group.calendar.google.com'
+CALENDAR_POOL = {}
+CALENDAR_POOL_DB_KEY = 'calendar_pool'
+# Status of an insert rejected because an event with its ID already exists
+DUPLICATE_EVENT_STATUS = 409
+# GCal event IDs use the base32hex alphabet (lower case) and these lengths
+GCAL_EVENT_ID_LENGTHS = (5, 1024)
+BASE32_TO_BASE32HEX = string.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567',
+                                       '0123456789abcdefghijklmnopqrstuv')
+# Statuses of a patch or delete of a GCal event which no longer exists
+LOST_EVENT_STATUSES = (404, 410)
+MAX_WRITE_ATTEMPTS = 5  # drain windows a failing write is retried for
+USER_CAL_INSTANCE_CACHE = {}
+USER_CAL_INSTANCE_TTL = 30  # seconds
+USER_CAL_MEMCACHE_TIMEOUT = 60 * 60  # seconds
+
+
+class CalendarPool(ndb.Model):
+  """Model for representing the calendars events are spread across.
+
+  Each calendar has its own write quota, so adding calendars to the pool
+  scales the write throughput of the app. Calendars should only ever be
+  appended, since events keep the calendar they were inserted into.
+  """
+  calendar_ids = ndb.StringProperty(repeated=True, indexed=False)
+
+
+def GetCalendarPool():
+  """Gets the IDs of the calendars events are spread across.
+
+  The pool is read from the CalendarPool entity once per instance, falling
+  back to the original calendar if it has not been created.
+
+  Returns:
+    A tuple of calendar IDs.
+  """
+  if 'IDS' not in CALENDAR_POOL:
+    calendar_pool = ndb.Key(CalendarPool, CALENDAR_POOL_DB_KEY).get()
+    if calendar_pool is None or not calendar_pool.calendar_ids:
+      CALENDAR_POOL['IDS'] = (CALENDAR_ID,)
+    else:
+      CALENDAR_POOL['IDS'] = tuple(calendar_pool.calendar_ids)
+
+  return CALENDAR_POOL['IDS']
+
+
+def AssignCalendar(uid):
+  """Chooses the calendar a new event will be inserted into.
+
+  Args:
+    uid: The UID of the event.
+
+  Returns:
+    A calendar ID from the pool, chosen by a hash of {uid} so that events are
+        spread evenly and the same UID is always placed in the same calendar.
+  """
+  pool = GetCalendarPool()
+  digest = hashlib.md5(uid.encode('utf-8')).hexdigest()
+  return pool[int(digest, 16) % len(pool)]
+
+
+def Base32HexId(name):
+  """Encodes a string as a valid GCal event ID.
+
+  Args:
+    name: A byte string.
+
+  Returns:
+    The base32hex encoding of {name}, without padding. If that would not be a
+        valid length for an event ID, the encoding of a SHA-256 digest of
+        {name} is used instead.
+  """
+  encoded = base64.b32encode(name).rstrip('=').translate(BASE32_TO_BASE32HEX)
+  min_length, max_length = GCAL_EVENT_ID_LENGTHS
+  if not min_length <= len(encoded) <= max_length:
+    digest = hashlib.sha256(name).digest()
+    encoded = base64.b32encode(digest).rstrip('=').translate(
+        BASE32_TO_BASE32HEX)
+  return encoded
 
 
 class TimeKeyword(ndb.Model):  # pylint:disable-msg=R0904
@@ -48,8 +131,8 @@ class TimeKeyword(ndb.Model):  # pylint:disable-msg=R0904
   useful to keep around.
   """
   # pylint:disable-msg=E1101
-  keyword = ndb.StringProperty(required=True)
-  value = ndb.StringProperty(required=True)
+  keyword = ndb.StringProperty(required=True, indexed=False)
+  value = ndb.StringProperty(required=True, indexed=False)
 
   @classmethod
   # pylint:disable-msg=C0103
@@ -74,6 +157,17 @@ class TimeKeyword(ndb.Model):  # pylint:disable-msg=R0904
     """Returns the TimeKeyword as a dictionary with keyword as key for value."""
     return {self.keyword: self.value}
 
+  def as_patch_dict(self):  # pylint:disable-msg=C0103
+    """Returns the TimeKeyword as a dictionary to be sent in a patch.
+
+    A patch merges nested objects, so the other keyword is explicitly set to
+    null; otherwise a change between an all-day and a timed event would leave
+    both date and dateTime set, which the API rejects.
+    """
+    patch_dict = {'date': None, 'dateTime': None}
+    patch_dict.update(self.as_dict())
+    return patch_dict
+
   def to_datetime(self):  # pylint:disable-msg=C0103
     """Returns the TimeKeyword as a datetime.datetime.
 
@@ -144,126 +238,186 @@ def ConvertedDescription(ical_event):
 
 
 class Event(ndb.Model):  # pylint:disable-msg=R0904
-  """Holds data for a calendar event (including shared attendees)."""
+  """Holds data for a calendar event (including shared attendees).
+
+  The only queries on Event are the range query on end_date used by
+  MonthlyCleanup and the lookup by gcal_edit used by calendar reconciliation,
+  so every other property is explicitly unindexed to keep the number of index
+  writes per put small.
+
+  Events are rewritten by every sync task which touches them, so they are kept
+  out of memcache to avoid churning it; the per-request context cache is
+  still used.
+  """
+  _use_memcache = False
+
   # pylint:disable-msg=E1101
   description = ndb.TextProperty(default='')
   start = ndb.StructuredProperty(TimeKeyword, required=True)
   end = ndb.StructuredProperty(TimeKeyword, required=True)
-  location = ndb.StringProperty(default='')
-  summary = ndb.StringProperty(required=True)
-  attendees = ndb.UserProperty(repeated=True)
+  location = ndb.StringProperty(default='', indexed=False)
+  summary = ndb.StringProperty(required=True, indexed=False)
+  attendees = ndb.UserProperty(repeated=True, indexed=False)
   gcal_edit = ndb.StringProperty()
-  sequence = ndb.IntegerProperty(default=0)
+  sequence = ndb.IntegerProperty(default=0, indexed=False)
+  calendar_id = ndb.StringProperty(indexed=False)
+  # Number of GCal events of this event which have been lost, see gcal_event_id
+  gcal_generation = ndb.IntegerProperty(default=0, indexed=False)
+  # API fields whose stored values have not been sent to GCal yet
+  pending_fields = ndb.StringProperty(repeated=True, indexed=False)
 
-  def insert(self, credentials=None):  # pylint:disable-msg=C0103
-    """Will insert the event into GCal and then put the values into datastore.
+  # API fields changed since the event was loaded, not stored in the datastore
+  _changed_fields = frozenset()
+
+  @property
+  def changed_fields(self):  # pylint:disable-msg=C0103
+    """The API fields which have changed and will be sent in a patch."""
+    return self._changed_fields
+
+  def mark_changed(self, *fields):  # pylint:disable-msg=C0103
+    """Records API fields which have changed and should be sent in a patch.
 
     Args:
-      credentials: An OAuth2Credentials object used to build a service object.
-          In the case the credentials is the default value of None, future
-          methods will attempt to get credentials from the default credentials.
+      fields: Names of keys from as_dict, e.g. 'summary' or 'attendees'.
+    """
+    self._changed_fields = self._changed_fields.union(fields)
 
-    Returns:
-      A boolean value indicating whether the operation was successful.
+  def target_calendar_id(self):  # pylint:disable-msg=C0103
+    """Returns the ID of the calendar the event lives in.
 
-    Raises:
-      InappropriateAPIAction in the case that a corresponding GCal event has
-          already been inserted
+    Events inserted before sharding have no calendar_id and live in the
+    original calendar, while events yet to be inserted are assigned one.
     """
+    if self.calendar_id is not None:
+      return self.calendar_id
     if self.gcal_edit is not None:
-      raise InappropriateAPIAction('Insert attempted when id already set.')
+      return CALENDAR_ID
+    return AssignCalendar(self.key.id())
 
-    event_data = self.as_dict()
-    event_data.pop('id')
+  def gcal_event_id(self):  # pylint:disable-msg=C0103
+    """Returns the ID the event is inserted into GCal with.
 
-    inserted_event = AttemptAPIAction('insert', credentials=credentials,
-                                      calendarId=CALENDAR_ID, body=event_data)
-    if inserted_event is None:
-      return False  # failed
-
-    self.gcal_edit = inserted_event['id']
-    self.sequence = inserted_event.get('sequence', 0)
-    self.put()
+    The ID is derived from the UID, so an insert sent again after its result
+    was lost is rejected as a duplicate instead of creating a second event.
+    Once a GCal event is gone (see clear_gcal_edit) its ID can't be reused,
+    so the number of lost events is part of the ID.
+    """
+    name = self.key.id().encode('utf-8')
+    if self.gcal_generation:
+      name = '{:d}:{}'.format(self.gcal_generation, name)
+    return Base32HexId(name)
 
-    return True
+  def clear_gcal_edit(self):  # pylint:disable-msg=C0103
+    """Forgets the GCal event, which has been deleted, without a put."""
+    self.gcal_edit = None
+    self.calendar_id = None
+    self.gcal_generation += 1
 
-  def update(self, credentials=None):  # pylint:disable-msg=C0103
-    """Will update the event in GCal and then put updated values to datastore.
+  def pending_action(self):  # pylint:disable-msg=C0103
+    """Determines the API action which brings GCal up to the stored state.
 
-    Args:
-      credentials: An OAuth2Credentials object used to build a service object.
-          In the case the credentials is the default value of None, future
-          methods will attempt to get credentials from the default credentials.
+    An event with no attendees left is deleted, an event not yet in GCal is
+    inserted and otherwise the pending fields are patched.
 
     Returns:
-      A boolean value indicating whether the operation was successful.
-
-    Raises:
-      InappropriateAPIAction in the case that there is no GCal event to update
+      One of 'insert', 'patch', 'delete' or None if no request is needed. For
+          a patch, the pending fields are recorded as changed fields.
     """
+    if not self.attendees:
+      return 'delete' if self.gcal_edit is not None else None
     if self.gcal_edit is None:
-      raise InappropriateAPIAction('Update attempted when id not set.')
+      return 'insert'
+    if self.pending_fields:
+      self.mark_changed(*self.pending_fields)
+      return 'patch'
+    return None
 
-    log_msg = '{} updated'.format(self.gcal_edit)
-    updated_event = AttemptAPIAction('update', log_msg=log_msg,
-                                     credentials=credentials,
-                                     calendarId=CALENDAR_ID,
-                                     eventId=self.gcal_edit,
-                                     body=self.as_dict())
+  def api_request(self, action):  # pylint:disable-msg=C0103
+    """Builds the API request which carries out an action on the GCal event.
 
-    if updated_event is None:
-      return False  # failed
+    A patch only sends the fields in changed_fields (with start and end as in
+    TimeKeyword.as_patch_dict), while an update sends the full event body.
+    An insert sets the ID of the new event (see gcal_event_id).
 
-    sequence = updated_event.get('sequence', None)
-    if sequence is not None:
-      self.sequence = sequence
-    self.put()
+    Args:
+      action: One of 'insert', 'update', 'patch' or 'delete'.
 
-    return True
+    Returns:
+      A pair (http_verb, kwargs) where http_verb is the name of the API method
+          and kwargs are the keyword arguments to be passed to it.
 
-  # pylint:disable-msg=C0103,W0221
-  def delete(self, credentials=None):
-    """Will delete the event in GCal and then delete from the datastore.
+    Raises:
+      InappropriateAPIAction in the case that the action does not match the
+          state of the event (e.g. an insert when the id is already set)
+    """
+    if action == 'insert':
+      if self.gcal_edit is not None:
+        raise InappropriateAPIAction('Insert attempted when id already set.')
+
+      event_data = self.as_dict()
+      event_data['id'] = self.gcal_event_id()
+      return action, {'calendarId': self.target_calendar_id(),
+                      'body': event_data}
+
+    if self.gcal_edit is None:
+      raise InappropriateAPIAction(
+          '{} attempted when id not set.'.format(action.capitalize()))
+
+    kwargs = {'calendarId': self.target_calendar_id(),
+              'eventId': self.gcal_edit}
+    if action == 'update':
+      kwargs['body'] = self.as_dict()
+    elif action == 'patch':
+      event_data = self.as_dict()
+      event_data['start'] = self.start.as_patch_dict()
+      event_data['end'] = self.end.as_patch_dict()
+      kwargs['body'] = dict((field, event_data[field])
+                            for field in self.changed_fields)
+    return action, kwargs
+
+  def apply_api_result(self, action, result):  # pylint:disable-msg=C0103
+    """Records the result of an API request on the event without a put.
 
     Args:
-      credentials: An OAuth2Credentials object used to build a service object.
-          In the case the credentials is the default value of None, future
-          methods will attempt to get credentials from the default credentials.
+      action: One of 'insert', 'update', 'patch' or 'delete'.
+      result: The result of the API request, or None if it failed.
 
-    Raises:
-      InappropriateAPIAction in the case that there is no GCal event to delete
+    Returns:
+      A boolean value indicating whether the operation was successful.
     """
-    if self.gcal_edit is None:
-      raise InappropriateAPIAction('Update attempted when id not set.')
+    if result is None:
+      return False  # failed
 
-    log_msg = '{} deleted'.format(self.gcal_edit)
-    delete_response = AttemptAPIAction('delete', log_msg=log_msg,
-                                       credentials=credentials,
-                                       calendarId=CALENDAR_ID,
-                                       eventId=self.gcal_edit)
-    if delete_response is None:
-      return
+    if action == 'insert':
+      self.calendar_id = self.target_calendar_id()
+      self.gcal_edit = result['id']
+      self.sequence = result.get('sequence', 0)
+    elif action in ('update', 'patch'):
+      sequence = result.get('sequence', None)
+      if sequence is not None:
+        self.sequence = sequence
 
-    self.key.delete()
+    self._changed_fields = frozenset()
+    return True
 
   @classmethod
   # pylint:disable-msg=C0103
-  def from_ical_event(cls, ical_event, current_user, credentials=None):
-    """Class method to update/add an event from an ical_event.
+  def parse_ical_event(cls, ical_event, current_user):
+    """Class method to determine the API action needed for an ical_event.
 
-    It either retrieves an existing instance and updates it, or if no such
-    object exists, creates a new one with the attributes from the ical_event.
+    It either retrieves an existing instance and updates its attributes, or if
+    no such object exists, creates a new one with the attributes from the
+    ical_event. No API request or datastore write is made.
 
     Args:
       ical_event: an icalendar.cal.Event object to be parsed
       current_user: a User instance corresponding to the user that is updating
-      credentials: An OAuth2Credentials object used to build a service object.
-          In the case the credentials is the default value of None, future
-          methods will attempt to get credentials from the default credentials.
 
     Returns:
-      A pair event, failed where event is an Event object that has been inserted
-          or updated and failed is a boolean indicating failure (or lack of).
+      A pair event, action where event is an Event object with the attributes
+          from the ical_event and action is one of 'insert', 'patch' or None
+          (if nothing has changed). For a patch, the changed fields are
+          recorded on the event (see changed_fields).
 
     Raises:
       MissingUID in the case that there is no UID in the iCal event
@@ -290,28 +444,23 @@ class Event(ndb.Model):  # pylint:disable-msg=R0904
 
     event = ndb.Key(cls, uid).get()
     if event is not None:
-      changed = False
       for attr, value in event_data.iteritems():
         if getattr(event, attr) != value:
           setattr(event, attr, value)
           logging.info('{attr} changed for {uid}'.format(attr=attr, uid=uid))
-          changed = True
+          event.mark_changed(attr)  # pylint:disable-msg=E1103
 
       if current_user not in event.attendees:  # pylint:disable-msg=E1103
         event.attendees.append(current_user)  # pylint:disable-msg=E1103
         logging.info('attendees changed for {uid}'.format(uid=uid))
-        changed = True
+        event.mark_changed('attendees')  # pylint:disable-msg=E1103
 
-      success = True
-      if changed:
-        # pylint:disable-msg=E1103
-        success = event.update(credentials=credentials)
-      return event, not success
+      # pylint:disable-msg=E1103
+      return event, 'patch' if event.changed_fields else None
     else:
       # pylint:disable-msg=W0142
       event = cls(key=ndb.Key(cls, uid), attendees=[current_user], **event_data)
-      success = event.insert(credentials=credentials)
-      return event, not success
+      return event, 'insert'
 
   @ndb.ComputedProperty
   def end_date(self):  # pylint:disable-msg=C0103
@@ -344,19 +493,503 @@ class Event(ndb.Model):  # pylint:disable-msg=R0904
     return 'Event(name={})'.format(self.key.id())
 
 
+class PendingWrite(ndb.Model):
+  """Model marking an Event whose stored state has not been sent to GCal.
+
+  Keyed by the event UID, so an event has at most one pending write however
+  many times its state changes before the queue is drained; only the latest
+  state is sent. The version is bumped by every change, so the drainer can
+  tell whether the state it sent has since been superseded. The failed
+  attempts to send the current version are counted, so that a write which
+  keeps failing is abandoned after MAX_WRITE_ATTEMPTS.
+  """
+  _use_memcache = False
+
+  version = ndb.IntegerProperty(default=0, indexed=False)
+  attempts = ndb.IntegerProperty(default=0, indexed=False)
+
+
+@ndb.tasklet
+def RecordEventStateAsync(event, added=(), removed=(), lost_gcal_edit=None):
+  """Records the desired state of an event, to be written behind to GCal.
+
+  The changed fields of {event} and the attendee changes are applied to the
+  stored event in a transaction, so that concurrent tasks for users sharing
+  the event do not overwrite each other, and a PendingWrite is recorded.
+
+  Args:
+    event: An Event as returned by Event.parse_ical_event, whose changed
+        fields (see changed_fields) will be stored. If no event is stored
+        with the same key, {event} itself is stored.
+    added: A list of User instances to be added as attendees.
+    removed: A list of User instances to be removed as attendees.
+    lost_gcal_edit: The ID of a GCal event which no longer exists. If the
+        stored event still refers to it, the event is inserted again.
+
+  Returns:
+    A future whose result is a boolean indicating whether the stored event
+        changed (and so a PendingWrite was recorded).
+  """
+  event_key = event.key
+
+  def Record():
+    """Applies the changes to the stored event and marks it pending."""
+    stored = event_key.get()
+    if stored is None:
+      if not added:
+        return False
+      stored = event
+      fields = set(event.as_dict()).difference(['id', 'sequence'])
+    else:
+      fields = set(event.changed_fields)
+      for field in fields.difference(['attendees']):
+        setattr(stored, field, getattr(event, field))
+
+    if lost_gcal_edit is not None and stored.gcal_edit == lost_gcal_edit:
+      stored.clear_gcal_edit()
+      fields.update(set(stored.as_dict()).difference(['id', 'sequence']))
+
+    attendees = [attendee for attendee in stored.attendees
+                 if attendee not in removed]
+    attendees.extend(attendee for attendee in added
+                     if attendee not in attendees)
+    if attendees != stored.attendees:
+      stored.attendees = attendees
+      fields.add('attendees')
+
+    if not fields:
+      return False
+
+    stored.pending_fields = sorted(fields.union(stored.pending_fields))
+    write_key = ndb.Key(PendingWrite, event_key.id())
+    pending_write = write_key.get() or PendingWrite(key=write_key)
+    pending_write.version += 1
+    pending_write.attempts = 0
+    ndb.put_multi([stored, pending_write])
+    return True
+
+  changed = yield ndb.transaction_async(Record, xg=True)
+  raise ndb.Return(changed)
+
+
+@ndb.tasklet
+def RecordWriteResultAsync(write_key, version, action, result, status=None):
+  """Records the result of draining a PendingWrite.
+
+  If the event changed again after the write was loaded, the result is still
+  recorded on the event but the PendingWrite is kept for the next drain.
+
+  A patch or delete which fails with one of LOST_EVENT_STATUSES means the GCal
+  event no longer exists. The delete is then done, while for a patch the
+  gcal_edit is cleared so the next drain inserts the event again. An insert
+  which fails with DUPLICATE_EVENT_STATUS was already made by an earlier
+  attempt, so it is recorded as done. Any other failure counts as an attempt,
+  and after MAX_WRITE_ATTEMPTS the write is abandoned: the PendingWrite is
+  deleted and the pending fields cleared.
+
+  Args:
+    write_key: The ndb.Key of the PendingWrite.
+    version: The version of the PendingWrite when it was loaded.
+    action: The action sent to GCal (see Event.pending_action), or None if no
+        request was needed.
+    result: The result of the API request, or None if it failed.
+    status: The HTTP status of the failed API request, if known.
+
+  Returns:
+    A future whose result is one of 'done', 'retry' (the write is kept for
+        the next drain) or 'abandoned'.
+  """
+  event_key = ndb.Key(Event, write_key.id())
+  lost = (result is None and status in LOST_EVENT_STATUSES and
+          action in ('patch', 'delete'))
+  duplicate = (result is None and status == DUPLICATE_EVENT_STATUS and
+               action == 'insert')
+
+  def RecordFailure(pending_write, event):
+    """Counts a failed attempt, abandoning the write after the last one."""
+    if pending_write is None:
+      return 'done'
+    if pending_write.version != version:
+      return 'retry'  # the newer state gets attempts of its own
+
+    pending_write.attempts += 1
+    if pending_write.attempts < MAX_WRITE_ATTEMPTS:
+      pending_write.put()
+      return 'retry'
+
+    write_key.delete()
+    if event is not None:
+      event.pending_fields = []
+      event.put()
+    return 'abandoned'
+
+  def Record():
+    """Applies the result to the stored event and clears the pending write."""
+    pending_write, event = ndb.get_multi([write_key, event_key])
+    api_result = result
+    if duplicate and event is not None:
+      # Inserted by an earlier attempt whose result was lost
+      api_result = {'id': event.gcal_event_id()}
+
+    if action is not None:
+      if api_result is None and not lost:
+        return RecordFailure(pending_write, event)
+      if event is not None:
+        if action == 'delete' or lost:
+          event.clear_gcal_edit()
+        else:
+          event.apply_api_result(action, api_result)
+
+      if lost and action == 'patch' and event is not None:
+        # Kept pending, with every field, so the event is inserted again
+        fields = set(event.as_dict()).difference(['id', 'sequence'])
+        event.pending_fields = sorted(fields)
+        event.put()
+        return 'retry'
+
+    if pending_write is not None and pending_write.version != version:
+      if event is not None:
+        event.put()
+      return 'retry'
+
+    ndb.delete_multi([write_key])
+    if event is not None:
+      if event.attendees:
+        event.pending_fields = []
+        event.put()
+      else:
+        event.key.delete()
+    return 'done'
+
+  outcome = yield ndb.transaction_async(Record, xg=True)
+  raise ndb.Return(outcome)
+
+
+class UIDSetProperty(ndb.BlobProperty):
+  """Property for storing a set of event UIDs as a single unindexed blob.
+
+  The UIDs are de-duplicated, sorted and joined by newlines before being
+  stored (compressed by default), so the property costs a constant number of
+  index writes (zero) no matter how many UIDs it holds. The user value is
+  always a sorted list of unique UIDs.
+  """
+
+  def __init__(self, name=None, compressed=True, **kwds):
+    """Constructor for UIDSetProperty.
+
+    Args:
+      name: The (optional) name of the property in the datastore.
+      compressed: Boolean indicating whether the stored blob should be
+          compressed. Defaults to True.
+      kwds: Other keyword arguments accepted by ndb.BlobProperty.
+    """
+    kwds.setdefault('default', ())
+    super(UIDSetProperty, self).__init__(name=name, compressed=compressed,
+                                         **kwds)
+
+  def _validate(self, value):  # pylint:disable-msg=C0103
+    """Validates a collection of UIDs and returns it as a sorted list."""
+    if not isinstance(value, (list, tuple, set, frozenset)):
+      raise datastore_errors.BadValueError(
+          'Expected a collection of UIDs, got {!r}'.format(value))
+    return sorted(set(value))
+
+  def _to_base_type(self, value):  # pylint:disable-msg=C0103
+    """Converts a collection of UIDs into a newline separated string."""
+    return '\n'.join(sorted(set(value))).encode('utf-8')
+
+  def _from_base_type(self, value):  # pylint:disable-msg=C0103
+    """Converts a newline separated string into a sorted list of UIDs."""
+    if not value:
+      return []
+    return value.decode('utf-8').split('\n')
+
+
 class UserCal(ndb.Model):  # pylint:disable-msg=R0903
-  """Holds data for a calendar event (including shared owners)."""
+  """Holds data for a calendar event (including shared owners).
+
+  The cron handler queries on update_intervals, so it is the only indexed
+  property.
+
+  UserCal is read on every page and AJAX request but rarely written, so it is
+  served from memcache (ndb invalidates it on put) and, for read-only views,
+  from a short-lived per-instance cache via get_cached.
+  """
+  _use_memcache = True
+  _memcache_timeout = USER_CAL_MEMCACHE_TIMEOUT
+
   # pylint:disable-msg=E1101
-  owner = ndb.UserProperty(required=True)
-  calendars = ndb.StringProperty(repeated=True)
+  owner = ndb.UserProperty(required=True, indexed=False)
+  calendars = ndb.StringProperty(repeated=True, indexed=False)
   update_intervals = ndb.IntegerProperty(repeated=True)
-  upcoming = ndb.StringProperty(repeated=True)
+  upcoming = UIDSetProperty()
+
+  @classmethod
+  # pylint:disable-msg=C0103
+  def get_cached(cls, user_id):
+    """Class method to get a UserCal from the per-instance cache.
+
+    Falls back to a get (context cache, then memcache, then datastore) on a
+    miss or once the cached value is older than USER_CAL_INSTANCE_TTL. Since
+    other instances may have put a newer value in the meantime, this must
+    only be used for read-only views and never to read-modify-write.
 
-  def put(self):  # pylint:disable-msg=C0103
-    """Customized put function that first sorts the list in upcoming."""
-    self.upcoming = sorted(set(self.upcoming))
-    super(UserCal, self).put()
+    Args:
+      user_id: The user id used as the key name of the UserCal.
+
+    Returns:
+      The UserCal instance, or None if none exists.
+    """
+    cached = USER_CAL_INSTANCE_CACHE.get(user_id)
+    if cached is not None and time.time() - cached[0] < USER_CAL_INSTANCE_TTL:
+      return cached[1]
+
+    user_cal = ndb.Key(cls, user_id).get()
+    if user_cal is not None:
+      USER_CAL_INSTANCE_CACHE[user_id] = (time.time(), user_cal)
+    return user_cal
+
+  def _post_put_hook(self, future):  # pylint:disable-msg=C0103
+    """Refreshes the per-instance cache after a successful put."""
+    if future.get_exception() is None:
+      USER_CAL_INSTANCE_CACHE[self.key.id()] = (time.time(), self)
 
   def __repr__(self):
     return 'UserCal(owner={owner},name={name})'.format(owner=self.owner.email(),
                                                        name=self.key.id())
+
+
+class LatestSync(ndb.Model):  # pylint:disable-msg=R0903
+  """Model recording the most recently started sync of a user.
+
+  Keyed by the same ID as the UserCal. A sync which has been superseded by a
+  later one must not update the user's upcoming events, since its view of
+  the user's feeds is out of date.
+  """
+  _use_memcache = False
+
+  sync_id = ndb.IntegerProperty(indexed=False)
+
+  @classmethod
+  def superseded(cls, user_cal_id, sync_id):  # pylint:disable-msg=C0103
+    """Class method to check whether a later sync of a user has started.
+
+    Args:
+      user_cal_id: The ID of the UserCal being synced.
+      sync_id: The sync ID of the SyncCheckpoint of the sync.
+
+    Returns:
+      A boolean value indicating whether the sync has been superseded.
+    """
+    latest = ndb.Key(cls, user_cal_id).get()
+    return latest is not None and latest.sync_id != sync_id
+
+
+class SyncCheckpoint(ndb.Model):  # pylint:disable-msg=R0903
+  """Progress of a sync of a user's subscriptions.
+
+  Keyed by a sync ID allocated when the sync starts, so that syncs of the
+  same user never share state. Each subscribed feed is synced by its own
+  task, which keeps its progress in a FeedCheckpoint; this records which
+  feeds have finished, so that the upcoming events can be updated once all
+  of them have.
+  """
+  _use_memcache = False
+
+  # pylint:disable-msg=E1101
+  user_cal_id = ndb.StringProperty(indexed=False)
+  links = ndb.StringProperty(repeated=True, indexed=False)
+  finished = ndb.IntegerProperty(repeated=True, indexed=False)
+  dry_run = ndb.BooleanProperty(default=False, indexed=False)
+  # Indexed so MonthlyCleanup can delete the checkpoints of abandoned syncs
+  started = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def start(cls, user_cal, dry_run=False):  # pylint:disable-msg=C0103
+    """Class method to store a new checkpoint for a sync of a user.
+
+    A FeedCheckpoint is stored for each feed along with it, and the sync is
+    recorded as the user's LatestSync, superseding any sync of the user which
+    is still running. A dry run is not recorded, since it changes nothing
+    and live syncs must not be superseded by it.
+
+    Args:
+      user_cal: a UserCal object whose subscriptions will be synced
+      dry_run: Boolean indicating whether the sync is a dry run. Defaults to
+          False.
+
+    Returns:
+      The stored SyncCheckpoint.
+    """
+    sync_id, _ = cls.allocate_ids(1)
+    user_cal_id = user_cal.key.id()
+    checkpoint = cls(id=sync_id, user_cal_id=user_cal_id,
+                     links=user_cal.calendars, dry_run=dry_run)
+    feed_keys = checkpoint.feed_keys()
+    feeds = [FeedCheckpoint(key=feed_key, user_cal_id=user_cal_id, link=link,
+                            dry_run=dry_run)
+             for feed_key, link in zip(feed_keys, checkpoint.links)]
+    if not dry_run:
+      feeds.append(LatestSync(id=user_cal_id, sync_id=sync_id))
+    ndb.put_multi([checkpoint] + feeds)
+    return checkpoint
+
+  def feed_keys(self):  # pylint:disable-msg=C0103
+    """Returns the keys of the FeedCheckpoint's, in the order of the links."""
+    return [FeedCheckpoint.key_for(self.key, index)
+            for index in range(len(self.links))]
+
+  @property
+  def user_cal_key(self):  # pylint:disable-msg=C0103
+    """Key of the UserCal being synced."""
+    return ndb.Key(UserCal, self.user_cal_id)
+
+  def superseded(self):  # pylint:disable-msg=C0103
+    """Returns True if a later sync of the user has been started."""
+    # Dry runs are never recorded as the LatestSync
+    return (not self.dry_run and
+            LatestSync.superseded(self.user_cal_id, self.key.id()))
+
+
+class FeedCheckpoint(ndb.Model):  # pylint:disable-msg=R0903
+  """Progress of a sync of one of a user's subscribed feeds.
+
+  Keyed by the sync ID of the SyncCheckpoint and the index of the feed. These
+  are root entities, rather than children of the SyncCheckpoint, so the feeds
+  of a user can save their progress in parallel. Tasks which resume a feed
+  carry only the key, and the checkpoint is saved as the sync goes, so
+  progress survives a task being retried after it partly ran.
+  """
+  _use_memcache = False
+
+  # pylint:disable-msg=E1101
+  user_cal_id = ndb.StringProperty(indexed=False)
+  link = ndb.StringProperty(indexed=False)
+  last_used_uid = ndb.StringProperty(indexed=False)
+  upcoming = UIDSetProperty()
+  dry_run = ndb.BooleanProperty(default=False, indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+
+  @classmethod
+  def key_for(cls, checkpoint_key, index):  # pylint:disable-msg=C0103
+    """Class method to get the key for the checkpoint of a feed.
+
+    Args:
+      checkpoint_key: The ndb.Key of the SyncCheckpoint.
+      index: The index of the feed in SyncCheckpoint.links.
+
+    Returns:
+      An ndb.Key for a FeedCheckpoint.
+    """
+    return ndb.Key(cls, '{:d}:{:d}'.format(checkpoint_key.id(), index))
+
+  @property
+  def checkpoint_key(self):  # pylint:disable-msg=C0103
+    """Key of the SyncCheckpoint of the sync this feed is part of."""
+    return ndb.Key(SyncCheckpoint, int(self.key.id().split(':', 1)[0]))
+
+  @property
+  def index(self):  # pylint:disable-msg=C0103
+    """Index of the feed in SyncCheckpoint.links."""
+    return int(self.key.id().split(':', 1)[1])
+
+  @property
+  def user_cal_key(self):  # pylint:disable-msg=C0103
+    """Key of the UserCal being synced."""
+    return ndb.Key(UserCal, self.user_cal_id)
+
+  def superseded(self):  # pylint:disable-msg=C0103
+    """Returns True if a later sync of the user has been started."""
+    # Dry runs are never recorded as the LatestSync
+    return (not self.dry_run and
+            LatestSync.superseded(self.user_cal_id, self.checkpoint_key.id()))
+
+
+def RecordFeedFinished(feed_key, on_last_finished):
+  """Records that a feed has finished syncing.
+
+  Args:
+    feed_key: The ndb.Key of the FeedCheckpoint.
+    on_last_finished: A callable taking no arguments, called inside the
+        transaction if this is the last feed of the sync to finish. It should
+        enqueue a transactional task (e.g. UpdateUpcoming), which is then
+        enqueued exactly once per sync, even if tasks are retried.
+
+  Returns:
+    A boolean value indicating whether this was the last feed of the sync to
+        finish.
+  """
+
+  def Record():
+    """Marks the feed as done and adds it to the finished feeds."""
+    feed = feed_key.get()
+    if feed is None:
+      return False
+    feed.done = True
+
+    checkpoint = feed.checkpoint_key.get()
+    if checkpoint is None or feed.index in checkpoint.finished:
+      feed.put()
+      return False
+
+    checkpoint.finished.append(feed.index)
+    ndb.put_multi([feed, checkpoint])
+    if len(checkpoint.finished) != len(checkpoint.links):
+      return False
+    on_last_finished()
+    return True
+
+  return ndb.transaction(Record, xg=True)
+
+
+class Membership(ndb.Model):  # pylint:disable-msg=R0903
+  """Records that a user attends an event from one of their subscribed feeds.
+
+  Entities are keyed by the event UID with the UserCal key of the attendee as
+  parent. The events a user attends which end after a given time are served by
+  a single keys-only ancestor query on end (see index.yaml) and the UIDs come
+  straight from the keys, so no Event needs to be loaded.
+  """
+  _use_memcache = False
+
+  # pylint:disable-msg=E1101
+  feed = ndb.StringProperty(indexed=False)
+  end = ndb.StringProperty(required=True)
+
+  @classmethod
+  # pylint:disable-msg=C0103
+  def upcoming_uids(cls, user_key, now=None):
+    """Class method to get the UIDs of the events a user has upcoming.
+
+    Args:
+      user_key: The ndb.Key of the UserCal for the user.
+      now: A datetime.datetime to compare event end times against. Defaults to
+          the current UTC time.
+
+    Returns:
+      A sorted list of UIDs for events which end after {now}.
+    """
+    if now is None:
+      now = datetime.datetime.utcnow()
+    query = cls.query(cls.end > time_utils.FormatTime(now), ancestor=user_key)
+    return sorted(key.id() for key in query.iter(keys_only=True))
+
+  @classmethod
+  # pylint:disable-msg=C0103
+  def record(cls, memberships):
+    """Class method to put the memberships which are new or have changed.
+
+    Args:
+      memberships: A list of Membership instances.
+    """
+    stored = ndb.get_multi([membership.key for membership in memberships])
+    changed = [membership
+               for membership, stored_membership in zip(memberships, stored)
+               if stored_membership is None or
+               stored_membership.feed != membership.feed or
+               stored_membership.end != membership.end]
+    ndb.put_multi(changed)
+
+  def __repr__(self):
+    return 'Membership(user={user},uid={uid})'.format(
+        user=self.key.parent().id(), uid=self.key.id())
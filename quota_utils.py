@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""API quota utility library for persistent-cal.
+
+Provides a token bucket shared by every instance (through memcache) which
+each Calendar API call acquires from before it is sent. The bucket is
+refilled once per second (up to the per-second budget) and once per UTC day
+(up to the per-day budget).
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# General libraries
+import datetime
+import logging
+import time
+
+# App engine specific libraries
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# App specific libraries
+from custom_exceptions import RetryLater
+
+
+API_QUOTA = {}
+API_QUOTA_DB_KEY = 'api_quota'
+DEFAULT_CALLS_PER_DAY = 1000000
+DEFAULT_CALLS_PER_SECOND = 10
+MAX_QUOTA_WAIT = 8  # seconds, longer waits are deferred to a new task
+QUOTA_NAMESPACE = 'api-quota'
+
+
+class APIQuota(ndb.Model):
+  """Model for representing the Calendar API budgets for the project."""
+  calls_per_second = ndb.IntegerProperty(default=DEFAULT_CALLS_PER_SECOND,
+                                         indexed=False)
+  calls_per_day = ndb.IntegerProperty(default=DEFAULT_CALLS_PER_DAY,
+                                      indexed=False)
+
+
+def GetQuotaLimits():
+  """Gets the per-second and per-day API budgets.
+
+  The budgets are read from the APIQuota entity once per instance, falling
+  back to the defaults if it has not been created.
+
+  Returns:
+    A pair (calls_per_second, calls_per_day).
+  """
+  if 'LIMITS' not in API_QUOTA:
+    api_quota = ndb.Key(APIQuota, API_QUOTA_DB_KEY).get()
+    if api_quota is None:
+      api_quota = APIQuota()
+    API_QUOTA['LIMITS'] = (api_quota.calls_per_second, api_quota.calls_per_day)
+
+  return API_QUOTA['LIMITS']
+
+
+def SecondKey(timestamp):
+  """Memcache key for the calls made during the second containing timestamp."""
+  return 'second:{:d}'.format(int(timestamp))
+
+
+def DayKey(timestamp):
+  """Memcache key for the calls made during the UTC day containing timestamp."""
+  day = datetime.datetime.utcfromtimestamp(timestamp).date()
+  return 'day:{}'.format(day.isoformat())
+
+
+def SecondsUntilTomorrow(timestamp):
+  """Number of seconds from timestamp until the next UTC midnight."""
+  return 86400 - int(timestamp) % 86400
+
+
+def Take(key, num_calls, expiry):
+  """Takes tokens from a bucket stored in memcache.
+
+  Args:
+    key: The memcache key of the bucket (within QUOTA_NAMESPACE).
+    num_calls: The number of tokens to take.
+    expiry: Number of seconds before the bucket expires from memcache.
+
+  Returns:
+    The number of tokens used from the bucket including these, or None if
+        memcache is unavailable.
+  """
+  memcache.add(key, 0, time=expiry, namespace=QUOTA_NAMESPACE)
+  return memcache.incr(key, delta=num_calls, namespace=QUOTA_NAMESPACE)
+
+
+def AcquireAPIQuota(num_calls=1):
+  """Acquires quota for a number of API calls from the shared token bucket.
+
+  If the per-second budget is used up, waits for the next second. If memcache
+  is unavailable the calls are allowed, so that quota accounting failing does
+  not stop every sync.
+
+  Args:
+    num_calls: The number of API calls about to be made, e.g. the number of
+        sub-requests in a batch. Defaults to 1.
+
+  Raises:
+    RetryLater in the case that the per-day budget is used up, or the
+        per-second budget stays used up for longer than MAX_QUOTA_WAIT
+  """
+  calls_per_second, calls_per_day = GetQuotaLimits()
+
+  now = time.time()
+  day_key = DayKey(now)
+  day_used = Take(day_key, num_calls, 2 * 86400)
+  if day_used is not None and day_used > calls_per_day:
+    memcache.decr(day_key, delta=num_calls, namespace=QUOTA_NAMESPACE)
+    logging.info('Daily API budget of {:d} calls used up'.format(calls_per_day))
+    raise RetryLater(SecondsUntilTomorrow(now))
+
+  deadline = now + MAX_QUOTA_WAIT
+  while now < deadline:
+    used = Take(SecondKey(now), num_calls, 2)
+    # A batch larger than the per-second budget is let through on its own
+    if used is None or used <= calls_per_second or used == num_calls:
+      return
+
+    time.sleep(int(now) + 1 - now)
+    now = time.time()
+
+  memcache.decr(day_key, delta=num_calls, namespace=QUOTA_NAMESPACE)
+  raise RetryLater(MAX_QUOTA_WAIT)
+
+
+def GetAPIUsage():
+  """Gets the current usage of the shared API budgets.
+
+  Intended for applying backpressure, e.g. spacing out tasks before the
+  budgets are used up.
+
+  Returns:
+    A dictionary with the calls made in the current second and day along with
+        the corresponding budgets.
+  """
+  calls_per_second, calls_per_day = GetQuotaLimits()
+  now = time.time()
+  used = memcache.get_multi([SecondKey(now), DayKey(now)],
+                            namespace=QUOTA_NAMESPACE)
+  return {'second': used.get(SecondKey(now), 0),
+          'day': used.get(DayKey(now), 0),
+          'calls_per_second': calls_per_second,
+          'calls_per_day': calls_per_day}
@@ -0,0 +1,503 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Calendar reconciliation library for persistent-cal.
+
+Compares three states of each event: the desired state (the users' feeds, as
+recorded by Membership), the recorded state (Event) and the remote state (the
+calendar), and repairs any drift. The calendar is listed incrementally, using
+the syncToken returned by the previous listing, so that only the events
+changed remotely since the last run are compared. The first run (or any run
+after the token has expired) does a full listing to obtain a token. A full
+listing is also checked the other way round, for stored events which are
+missing from the calendar.
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# General libraries
+import datetime
+import logging
+
+# Third-party libraries
+from apiclient.errors import HttpError
+
+# App engine specific libraries
+from google.appengine.ext import ndb
+
+# App specific libraries
+from custom_exceptions import RetryLater
+from google_api_utils import AttemptAPIAction
+from google_api_utils import AttemptBatchAPIAction
+from handler_utils import DeferFunctionDecorator
+from handler_utils import EmailAdmins
+from library import ScheduleDrain
+from models import CALENDAR_ID
+from models import Event
+from models import Membership
+from models import PendingWrite
+from models import RecordEventStateAsync
+from models import UserCal
+import time_utils
+
+
+COMPARED_FIELDS = ('summary', 'location', 'description', 'start', 'end',
+                   'attendees')
+GCAL_EDIT_QUERY_SIZE = 30  # the maximum number of values in an IN filter
+LIST_PAGE_SIZE = 250
+RECONCILE_COST_BUDGET = 1000  # API calls per run
+SYNC_TOKEN_GONE = 410
+UNTRACKED_GRACE_PERIOD = datetime.timedelta(hours=1)
+
+
+class CalendarSyncState(ndb.Model):
+  """Model for the sync token of the incremental listing of a calendar.
+
+  Keyed by the calendar ID.
+  """
+  sync_token = ndb.StringProperty(indexed=False)
+  # Where a listing cut short by the budget resumes, with sync_token
+  page_token = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+def ListChangedEvents(calendar_id, sync_token=None, page_token=None,
+                      max_pages=None, credentials=None):
+  """Lists the events in a calendar changed since a sync token was issued.
+
+  Args:
+    calendar_id: The ID of the calendar to be listed.
+    sync_token: The nextSyncToken returned by a previous listing. Defaults to
+        None, in which case every event in the calendar is listed.
+    page_token: The page of an earlier listing (with the same {sync_token})
+        to resume from. Defaults to None, in which case the listing starts at
+        the first page.
+    max_pages: The maximum number of pages to retrieve. Defaults to None, in
+        which case every page is retrieved.
+    credentials: An OAuth2Credentials object used to build a service object.
+
+  Returns:
+    A tuple (remote_events, next_sync_token, next_page_token, num_pages)
+        where remote_events is a list of event resources (deleted events
+        have status 'cancelled'), num_pages is the number of pages retrieved
+        and exactly one of the tokens is set: next_sync_token is the token to
+        be used for the next listing once the last page is retrieved, and
+        next_page_token is the page to resume from if {max_pages} were
+        retrieved first. Both are None if a page could not be retrieved.
+
+  Raises:
+    HttpError with status 410 in the case that sync_token has expired
+    RetryLater in the case that the API budget is used up
+  """
+  remote_events = []
+  num_pages = 0
+  while True:
+    kwargs = {'calendarId': calendar_id, 'maxResults': LIST_PAGE_SIZE}
+    if sync_token is not None:
+      kwargs['syncToken'] = sync_token
+    if page_token is not None:
+      kwargs['pageToken'] = page_token
+
+    log_msg = 'Listed events in {}'.format(calendar_id)
+    page = AttemptAPIAction('list', log_msg=log_msg, credentials=credentials,
+                            reraise_statuses=(SYNC_TOKEN_GONE,), **kwargs)
+    if page is None:
+      return remote_events, None, None, num_pages
+
+    num_pages += 1
+    remote_events.extend(page.get('items', []))
+    page_token = page.get('nextPageToken')
+    if page_token is None:
+      return remote_events, page.get('nextSyncToken'), None, num_pages
+    if max_pages is not None and num_pages >= max_pages:
+      return remote_events, None, page_token, num_pages
+
+
+def NormalizeTime(time_dict):
+  """Normalizes a start or end time so stored and remote values compare.
+
+  Args:
+    time_dict: A dictionary with either a date or dateTime key, as returned
+        by TimeKeyword.as_dict or by the API.
+
+  Returns:
+    A pair (keyword, value) where value is a datetime.datetime in UTC for
+        dateTime values.
+  """
+  if 'dateTime' in time_dict:
+    return ('dateTime', time_utils.ParseRFC3339(time_dict['dateTime']))
+  return ('date', time_dict.get('date'))
+
+
+def DriftedFields(remote_event, event):
+  """Compares a remote event with the stored event it was created from.
+
+  Args:
+    remote_event: An event resource returned by the API.
+    event: The Event stored in the datastore.
+
+  Returns:
+    A list of the fields in COMPARED_FIELDS which differ.
+  """
+  expected = event.as_dict()
+  drifted = []
+  for field in COMPARED_FIELDS:
+    if field in ('start', 'end'):
+      same = (NormalizeTime(remote_event.get(field, {})) ==
+              NormalizeTime(expected[field]))
+    elif field == 'attendees':
+      same = (set(attendee['email'].lower()
+                  for attendee in remote_event.get(field, [])) ==
+              set(attendee['email'].lower() for attendee in expected[field]))
+    else:
+      same = (remote_event.get(field) or '') == (expected[field] or '')
+
+    if not same:
+      drifted.append(field)
+
+  return drifted
+
+
+def GetEventsByGcalEdit(gcal_edits):
+  """Gets the stored events for a collection of Google Calendar event IDs.
+
+  Args:
+    gcal_edits: An iterable of event IDs from the API.
+
+  Returns:
+    A dictionary mapping each event ID which has a stored Event to that Event.
+  """
+  gcal_edits = list(set(gcal_edits))
+  futures = []
+  for index in xrange(0, len(gcal_edits), GCAL_EDIT_QUERY_SIZE):
+    chunk = gcal_edits[index:index + GCAL_EDIT_QUERY_SIZE]
+    futures.append(Event.query(Event.gcal_edit.IN(chunk)).fetch_async())
+
+  result = {}
+  for future in futures:
+    for event in future.get_result():
+      result[event.gcal_edit] = event
+
+  return result
+
+
+def StaleAttendees(events, now):
+  """Finds attendees of upcoming events whose feeds no longer have them.
+
+  A user's feeds are the desired state: each event in them has a Membership
+  for the user (see UpdateUserSubscriptions), removed once the event leaves
+  the feeds. Users with no Membership at all have not synced since
+  memberships were introduced, so their feeds are unknown and they are
+  never reported.
+
+  Args:
+    events: A list of stored Event objects.
+    now: A datetime.datetime used to determine if an event is upcoming.
+
+  Returns:
+    A dictionary mapping the UID of each event with stale attendees to the
+        list of those attendees (User instances).
+  """
+  candidates = []
+  for event in events:
+    if event.end.to_datetime() <= now:
+      continue  # memberships of past events are not kept up to date
+    for attendee in event.attendees:
+      if attendee.user_id() is not None:
+        membership_key = ndb.Key(Membership, event.key.id(),
+                                 parent=ndb.Key(UserCal, attendee.user_id()))
+        candidates.append((event.key.id(), attendee, membership_key))
+
+  memberships = ndb.get_multi([key for _, _, key in candidates])
+  missing = [candidate
+             for candidate, membership in zip(candidates, memberships)
+             if membership is None]
+
+  user_cal_keys = set(key.parent() for _, _, key in missing)
+  futures = dict((user_cal_key,
+                  Membership.query(ancestor=user_cal_key).get_async(
+                      keys_only=True))
+                 for user_cal_key in user_cal_keys)
+  synced = set(user_cal_key for user_cal_key, future in futures.iteritems()
+               if future.get_result() is not None)
+
+  stale = {}
+  for uid, attendee, membership_key in missing:
+    if membership_key.parent() in synced:
+      stale.setdefault(uid, []).append(attendee)
+
+  return stale
+
+
+def FindDrift(remote_events, now):
+  """Compares changed remote events against the datastore and the feeds.
+
+  Events with changes waiting in the write-behind queue (see PendingWrite)
+  are skipped, since the queue will bring them in line, unless they were
+  deleted from the calendar: a pending patch of a deleted event can't
+  succeed, and an incremental listing won't show the deletion again.
+
+  Args:
+    remote_events: A list of event resources returned by ListChangedEvents.
+    now: A datetime.datetime used to determine if an event is upcoming.
+
+  Returns:
+    A list of tuples (kind, gcal_edit, event, detail) where event is the
+        stored Event (or None) and kind is one of
+        'deleted': removed from the calendar but still stored and attended,
+            detail is the event UID
+        'untracked': on the calendar but not stored, detail is the remote
+            event resource
+        'changed': differs from the stored event, detail is the list of
+            fields which differ
+        'stale': attended by users whose feeds no longer have it, detail is
+            the list of those users
+  """
+  stored = GetEventsByGcalEdit(remote_event['id']
+                               for remote_event in remote_events)
+  stale = StaleAttendees(stored.values(), now)
+
+  drift = []
+  for remote_event in remote_events:
+    gcal_edit = remote_event['id']
+    event = stored.get(gcal_edit)
+    if remote_event.get('status') == 'cancelled':
+      if event is not None and event.attendees:
+        drift.append(('deleted', gcal_edit, event, event.key.id()))
+      continue
+
+    if event is not None and (event.pending_fields or not event.attendees):
+      continue
+
+    if event is None:
+      drift.append(('untracked', gcal_edit, None, remote_event))
+    else:
+      fields = DriftedFields(remote_event, event)
+      if fields:
+        drift.append(('changed', gcal_edit, event, fields))
+      if event.key.id() in stale:
+        drift.append(('stale', gcal_edit, event, stale[event.key.id()]))
+
+  return drift
+
+
+def FindMissing(calendar_id, listed, now):
+  """Finds upcoming stored events which are missing from a calendar.
+
+  Listings only return the events GCal knows about, so this checks the stored
+  events against a full listing of the calendar instead. Events with changes
+  waiting in the write-behind queue are skipped, since the queue will send
+  them.
+
+  Args:
+    calendar_id: The ID of the calendar which was listed.
+    listed: A set of the IDs of every event (not cancelled) in the calendar.
+    now: A datetime.datetime used to determine if an event is upcoming.
+
+  Returns:
+    A list of tuples (kind, gcal_edit, event, detail) as returned by
+        FindDrift, where kind is one of
+        'missing': stored and attended, but its GCal event is not on the
+            calendar, detail is the event UID
+        'unsent': attended but never inserted into the calendar, with no
+            write pending (e.g. an abandoned insert), detail is the list of
+            fields to be sent
+  """
+  today = now.date().strftime('%Y-%m-%d')
+  candidates = []
+  for event in Event.query(Event.end_date >= today):
+    if not event.attendees or event.target_calendar_id() != calendar_id:
+      continue
+    if event.gcal_edit is None or event.gcal_edit not in listed:
+      candidates.append(event)
+
+  pending_writes = ndb.get_multi([ndb.Key(PendingWrite, event.key.id())
+                                  for event in candidates])
+  missing = []
+  for event, pending_write in zip(candidates, pending_writes):
+    if pending_write is not None:
+      continue
+    if event.gcal_edit is None:
+      fields = sorted(set(event.as_dict()).difference(['id', 'sequence']))
+      missing.append(('unsent', None, event, fields))
+    else:
+      missing.append(('missing', event.gcal_edit, event, event.key.id()))
+
+  return missing
+
+
+def RepairDrift(calendar_id, drift, budget, now, credentials=None):
+  """Repairs drift found by FindDrift, within a budget of API calls.
+
+  Stored events are repaired through the write-behind queue: a deleted or
+  missing event is inserted again, an unsent event is sent, a changed event
+  has the drifted fields sent again and stale attendees are removed.
+  Untracked events are deleted from the calendar in batch requests, unless
+  they were updated within UNTRACKED_GRACE_PERIOD (the result of a write may
+  not be recorded yet). Each repair is counted as one API call against {budget}.
+
+  Args:
+    calendar_id: The ID of the calendar being reconciled.
+    drift: A list of tuples as returned by FindDrift and FindMissing.
+    budget: The number of API calls which may be spent on repairs.
+    now: A datetime.datetime in UTC.
+    credentials: An OAuth2Credentials object used to build a service object.
+
+  Returns:
+    A pair (num_repaired, num_deferred) where num_deferred counts the drift
+        left for a later run (over budget, in the grace period or failed).
+  """
+  futures = []
+  deletes = []
+  num_deferred = 0
+  for kind, gcal_edit, event, detail in drift:
+    if budget <= 0:
+      num_deferred += 1
+      continue
+
+    if kind in ('deleted', 'missing'):
+      futures.append(RecordEventStateAsync(event, lost_gcal_edit=gcal_edit))
+    elif kind in ('changed', 'unsent'):
+      event.mark_changed(*detail)
+      futures.append(RecordEventStateAsync(event))
+    elif kind == 'stale':
+      futures.append(RecordEventStateAsync(event, removed=detail))
+    elif kind == 'untracked':
+      updated = detail.get('updated')
+      if (updated is not None and now - time_utils.ParseRFC3339(updated) <
+          UNTRACKED_GRACE_PERIOD):
+        num_deferred += 1
+        continue
+      deletes.append(('delete', {'calendarId': calendar_id,
+                                 'eventId': gcal_edit}))
+    budget -= 1
+
+  try:
+    results = AttemptBatchAPIAction(deletes, credentials=credentials)
+  except RetryLater as exc:
+    results = exc.results
+
+  # Failed deletes are deferred; an event which turns out to be gone already
+  # is listed as cancelled by the next run and so is no longer drift
+  num_deleted = len([result for result in results if result is not None])
+  num_recorded = len([future for future in futures if future.get_result()])
+  if num_recorded:
+    ScheduleDrain(credentials=credentials)
+
+  num_deferred += len(deletes) - num_deleted
+  return num_recorded + num_deleted, num_deferred
+
+
+@DeferFunctionDecorator
+def ReconcileCalendar(calendar_id=CALENDAR_ID, credentials=None, full=False,
+                      budget=RECONCILE_COST_BUDGET):
+  """Reconciles the feeds, the datastore and a calendar, and repairs drift.
+
+  The events changed on the calendar since the last run are compared against
+  the stored events and the users' feeds (see FindDrift), and the drift is
+  repaired (see RepairDrift). When the whole calendar was listed in the run,
+  the upcoming stored events are also checked against it (see FindMissing).
+  The listing costs one API call per page and stops after half of {budget},
+  saving the page to resume from; the repairs use what is left. The sync
+  token (or page) is only replaced once every repair for the pages retrieved
+  has been made, so a failed or over budget run is repeated from the same
+  point by the next run.
+
+  Args:
+    calendar_id: The ID of the calendar to be reconciled. Defaults to
+        CALENDAR_ID.
+    credentials: An OAuth2Credentials object used to build a service object.
+    full: If True, every event in the calendar is compared rather than those
+        changed since the last run. Defaults to False.
+    budget: The maximum number of API calls for the run. Defaults to
+        RECONCILE_COST_BUDGET.
+
+  Returns:
+    The list of drift found by FindDrift (and FindMissing), or None if the
+        listing failed.
+  """
+  state_key = ndb.Key(CalendarSyncState, calendar_id)
+  state = state_key.get() or CalendarSyncState(key=state_key)
+  sync_token = page_token = None
+  if not full:
+    sync_token, page_token = state.sync_token, state.page_token
+  # At least half of the budget is left for repairs
+  max_pages = max(1, budget // 2)
+
+  try:
+    try:
+      remote_events, next_sync_token, next_page_token, num_pages = (
+          ListChangedEvents(calendar_id, sync_token=sync_token,
+                            page_token=page_token, max_pages=max_pages,
+                            credentials=credentials))
+    except HttpError as exc:
+      if exc.resp.status != SYNC_TOKEN_GONE:
+        raise
+      logging.info('Sync token for {} expired, listing every event'.format(
+          calendar_id))
+      sync_token = None
+      remote_events, next_sync_token, next_page_token, num_pages = (
+          ListChangedEvents(calendar_id, max_pages=max_pages,
+                            credentials=credentials))
+  except RetryLater as exc:
+    logging.info('Reconciliation of {} deferred by {}s'.format(
+        calendar_id, exc.delay))
+    # pylint:disable-msg=E1123
+    ReconcileCalendar(calendar_id=calendar_id, credentials=credentials,
+                      full=full, budget=budget, defer_now=True,
+                      _countdown=exc.delay)
+    return
+
+  if next_sync_token is None and next_page_token is None:
+    logging.info('Listing {} failed, keeping previous sync token'.format(
+        calendar_id))
+    if page_token is not None:
+      # The saved page may have expired, so the next run starts the listing
+      # over rather than failing on it again
+      state.page_token = None
+      state.put()
+    return
+
+  now = datetime.datetime.utcnow()
+  drift = FindDrift(remote_events, now)
+  if sync_token is None and page_token is None and next_sync_token is not None:
+    # Every event on the calendar was listed by this run
+    listed = set(remote_event['id'] for remote_event in remote_events
+                 if remote_event.get('status') != 'cancelled')
+    drift.extend(FindMissing(calendar_id, listed, now))
+  num_repaired, num_deferred = RepairDrift(calendar_id, drift,
+                                           max(0, budget - num_pages), now,
+                                           credentials=credentials)
+  if drift:
+    msg = ('Reconciliation of {} repaired {:d} and deferred {:d} of:\n'
+           '{}'.format(calendar_id, num_repaired, num_deferred,
+                       '\n'.join(repr(entry[:2] + entry[3:])
+                                 for entry in drift)))
+    logging.info(msg)
+    EmailAdmins(msg, defer_now=True)  # pylint:disable-msg=E1123
+
+  if num_deferred == 0:
+    if next_page_token is not None:
+      logging.info('Listing of {} resumes from page {} next run'.format(
+          calendar_id, next_page_token))
+      state.sync_token, state.page_token = sync_token, next_page_token
+    else:
+      state.sync_token, state.page_token = next_sync_token, None
+    state.put()
+  return drift
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# Copyright (C) 2010-2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Subscription sync planning library for persistent-cal.
+
+Syncing a user is split in two. The planners diff parsed feed events (or the
+events which left a user's feeds) against the stored Event state and produce
+a SyncPlan without writing anything. ExecutePlan then records the plan, in
+batches, for DrainPendingWrites to send to GCal. A plan can be logged and
+sized without being executed, which is how dry runs work.
+
+Feeds of different users often share events. Executed events are recorded in
+a ledger in memcache, keyed by a digest of their UID and content, for the
+rest of the current LEDGER_WINDOW. When another subscriber's feed has the
+same content and the ledger shows the subscriber already attends, the event
+is neither loaded nor compared and only the membership is recorded. A ledger
+entry which is lost or stale only costs the full work being done again.
+"""
+
+
+__author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
+
+
+# General libraries
+import collections
+import hashlib
+import logging
+import time
+
+# App engine specific libraries
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# App specific libraries
+from models import Event
+from models import RecordEventStateAsync
+from models import TimeKeyword
+
+
+EXECUTE_BATCH_SIZE = 50  # transactions in flight at once
+LEDGER_FIELDS = ('uid', 'summary', 'description', 'location', 'dtstart',
+                 'dtend')
+LEDGER_NAMESPACE = 'event-ledger'
+LEDGER_WINDOW = 3 * 60 * 60  # seconds, one update interval
+PLAN_ACTIONS = ('insert', 'update', 'attend', 'register', 'unattend',
+                'delete')
+
+
+class SyncPlan(object):
+  """The changes needed to bring stored events in line with a user's feeds.
+
+  Each entry is a pair (event, action) where action is one of:
+    insert: a new event, with the user as its only attendee
+    update: fields of the event changed (possibly also adding the user)
+    attend: the user is added as an attendee, nothing else changed
+    register: the ledger shows the event is up to date and the user attends,
+        so only the membership is recorded
+    unattend: the user is removed as an attendee, others remain
+    delete: the user was the last attendee, so the event is removed
+    None: nothing changed
+  """
+
+  def __init__(self, user):
+    """Constructor for SyncPlan.
+
+    Args:
+      user: a User instance corresponding to the user being synced.
+    """
+    self.user = user
+    self.entries = collections.OrderedDict()
+    self.digests = {}
+
+  def add(self, event, action, digest=None):  # pylint:disable-msg=C0103
+    """Adds an entry for an event, replacing any earlier one for its UID.
+
+    Args:
+      event: An Event, as returned by Event.parse_ical_event or loaded.
+      action: One of PLAN_ACTIONS or None.
+      digest: The ContentDigest of the feed event {event} was parsed from, if
+          it should be recorded in the ledger once the plan is executed.
+    """
+    uid = event.key.id()
+    self.entries[uid] = (event, action)
+    if digest is None:
+      self.digests.pop(uid, None)
+    else:
+      self.digests[uid] = digest
+
+  def counts(self):  # pylint:disable-msg=C0103
+    """Returns a dictionary with the number of entries for each action."""
+    return collections.Counter(action for _, action in self.entries.values()
+                               if action is not None)
+
+  def __len__(self):
+    """Returns the number of entries which need a change to an event."""
+    counts = self.counts()
+    return sum(counts.values()) - counts['register']
+
+  def __repr__(self):
+    return 'SyncPlan(user={!r}, {!r})'.format(self.user.email(),
+                                              dict(self.counts()))
+
+
+def ContentDigest(ical_event):
+  """Digest of the UID and of the content of a feed event which is synced.
+
+  Args:
+    ical_event: an icalendar.cal.Event object (VEVENT component).
+
+  Returns:
+    A hex string which changes whenever a field used by
+        Event.parse_ical_event changes.
+  """
+  values = []
+  for name in LEDGER_FIELDS:
+    value = ical_event.get(name)
+    # Dates and times are compared by value, not by how they are written
+    values.append(unicode(getattr(value, 'dt', value)))
+  return hashlib.md5(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+
+def LedgerKey(digest, window):
+  """Memcache key for the ledger entry of a digest during a window."""
+  return '{:d}:{}'.format(window, digest)
+
+
+def LookupLedger(digests):
+  """Looks up the ledger entries for the current window.
+
+  Args:
+    digests: A list of ContentDigest strings.
+
+  Returns:
+    A dictionary from each digest which was executed during the current window
+        to a frozenset of the emails of the event's attendees.
+  """
+  window = int(time.time()) // LEDGER_WINDOW
+  keys = dict((LedgerKey(digest, window), digest) for digest in digests)
+  found = memcache.get_multi(keys.keys(), namespace=LEDGER_NAMESPACE)
+  return dict((keys[key], emails) for key, emails in found.iteritems())
+
+
+def RecordLedger(plan):
+  """Records the executed events of a plan in the ledger.
+
+  Args:
+    plan: A SyncPlan which has been executed.
+  """
+  window = int(time.time()) // LEDGER_WINDOW
+  mapping = {}
+  for uid, digest in plan.digests.iteritems():
+    event, _ = plan.entries[uid]
+    emails = frozenset(attendee.email() for attendee in event.attendees)
+    mapping[LedgerKey(digest, window)] = emails
+
+  if mapping:
+    memcache.set_multi(mapping, time=LEDGER_WINDOW, namespace=LEDGER_NAMESPACE)
+
+
+def PlanEvents(ical_events, current_user):
+  """Plans the changes for a chunk of parsed feed events.
+
+  Events whose content was executed during the current ledger window, with
+  {current_user} attending, are planned as 'register' without being loaded.
+  The other stored events are fetched with a single get_multi before the
+  events are diffed. If a UID appears more than once, the last occurrence
+  wins.
+
+  Args:
+    ical_events: A list of icalendar.cal.Event objects (VEVENT components).
+    current_user: a User instance corresponding to the user that is updating
+
+  Returns:
+    A SyncPlan with an entry for every event in {ical_events}.
+
+  Raises:
+    MissingUID in the case that there is no UID in an iCal event
+  """
+  digests = [ContentDigest(ical_event) for ical_event in ical_events]
+  ledger = LookupLedger(digests)
+  email = current_user.email()
+  registered = [email in ledger.get(digest, ()) for digest in digests]
+
+  # Warms the context cache used by the get in Event.parse_ical_event
+  ndb.get_multi([ndb.Key(Event, unicode(ical_event.get('uid', '')))
+                 for ical_event, skip in zip(ical_events, registered)
+                 if ical_event.get('uid') and not skip])
+
+  plan = SyncPlan(current_user)
+  for ical_event, digest, skip in zip(ical_events, digests, registered):
+    if skip:
+      # Never stored; only the key and end are used, for the membership
+      event = Event(key=ndb.Key(Event, unicode(ical_event.get('uid'))),
+                    end=TimeKeyword.from_ical_event(ical_event, 'dtend'))
+      plan.add(event, 'register')
+      continue
+
+    event, action = Event.parse_ical_event(ical_event, current_user)
+    if action == 'patch':
+      only_attendees = event.changed_fields == frozenset(['attendees'])
+      action = 'attend' if only_attendees else 'update'
+    plan.add(event, action, digest=digest)
+
+  return plan
+
+
+def PlanRemovals(events, current_user):
+  """Plans removing a user from events which have left the user's feeds.
+
+  Args:
+    events: A list of stored Event objects.
+    current_user: a User instance corresponding to the user being removed.
+
+  Returns:
+    A SyncPlan with an entry for every event {current_user} attends.
+  """
+  plan = SyncPlan(current_user)
+  for event in events:
+    # If federated identity not set, User.__cmp__ only uses email
+    if current_user not in event.attendees:
+      continue  # already handled, e.g. by an earlier attempt
+
+    plan.add(event, 'unattend' if len(event.attendees) > 1 else 'delete')
+
+  return plan
+
+
+def ExecutePlan(plan, dry_run=False):
+  """Records the changes in a plan, to be written behind to GCal.
+
+  The changes are recorded with RecordEventStateAsync, at most
+  EXECUTE_BATCH_SIZE transactions at a time. Once every change is recorded,
+  the parsed events of the plan are recorded in the ledger.
+
+  Args:
+    plan: A SyncPlan.
+    dry_run: If True, the plan is only logged. Defaults to False.
+
+  Returns:
+    A boolean value indicating whether any stored event changed, in which
+        case the caller should schedule DrainPendingWrites.
+  """
+  logging.info('{}executing {!r}'.format('Not ' if dry_run else '', plan))
+  if dry_run:
+    return False
+
+  changed = False
+  futures = []
+  for event, action in plan.entries.values():
+    if action in ('insert', 'update', 'attend'):
+      futures.append(RecordEventStateAsync(event, added=[plan.user]))
+    elif action in ('unattend', 'delete'):
+      futures.append(RecordEventStateAsync(event, removed=[plan.user]))
+    else:
+      continue
+
+    if len(futures) >= EXECUTE_BATCH_SIZE:
+      changed = any([future.get_result() for future in futures]) or changed
+      futures = []
+
+  changed = any([future.get_result() for future in futures]) or changed
+  RecordLedger(plan)
+  return changed
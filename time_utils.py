@@ -17,7 +17,8 @@
 
 """Time utility library for persistent-cal with no App Engine depencies.
 
-Provides time related parsing and conversion functions.
+Provides time related parsing and conversion functions, and the TimeBudget
+used by long running tasks.
 """
 
 
@@ -25,7 +26,22 @@ __author__ = 'daniel.j.hermes@gmail.com (Daniel Hermes)'
 
 
 # General libraries
+import calendar
 import datetime
+import re
+import time
+
+
+# Events ending further back than this are neither synced nor kept
+RETENTION_MONTHS = 3
+# Push queue tasks are stopped after 10 minutes. Work stops once less than the
+# margin is left, which must cover a feed fetch (60 second deadline) or a
+# chunk of planned events started just before the check.
+TASK_DEADLINE = 600
+TASK_SAFETY_MARGIN = 90
+RFC3339_PATTERN = re.compile(
+    r'^(?P<datetime>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?'
+    r'(?P<offset>Z|[+-]\d{2}:\d{2})$')
 
 
 def ConvertToInterval(timestamp):
@@ -78,3 +94,87 @@ def FormatTime(time_value):
     return time_value.strftime(time_parse)
   elif isinstance(time_value, datetime.date):
     return time_value.strftime(time_parse)
+
+
+def ParseRFC3339(value):
+  """Parses an RFC 3339 timestamp as returned by the calendar API.
+
+  Args:
+    value: A string such as 2012-01-01T12:00:00.000Z or
+        2012-01-01T05:00:00-07:00
+
+  Returns:
+    A naive datetime.datetime object in UTC
+
+  Raises:
+    ValueError in the case that value is not an RFC 3339 timestamp
+  """
+  match = RFC3339_PATTERN.match(value)
+  if match is None:
+    raise ValueError('Not an RFC 3339 timestamp: {!r}'.format(value))
+
+  result = datetime.datetime.strptime(match.group('datetime'),
+                                      '%Y-%m-%dT%H:%M:%S')
+  offset = match.group('offset')
+  if offset != 'Z':
+    delta = datetime.timedelta(hours=int(offset[1:3]),
+                               minutes=int(offset[4:6]))
+    result = result - delta if offset[0] == '+' else result + delta
+
+  return result
+
+
+def RetentionHorizon(relative_date, months=RETENTION_MONTHS):
+  """Gets the date a number of months before a date.
+
+  The day of the month is clamped to the length of the earlier month, so for
+  example three months before May 31 is February 28 (or 29).
+
+  Args:
+    relative_date: a datetime.date object
+    months: The number of months to go back. Defaults to RETENTION_MONTHS.
+
+  Returns:
+    A datetime.date object
+  """
+  month_index = 12 * relative_date.year + relative_date.month - 1 - months
+  year, month = divmod(month_index, 12)
+  month += 1
+  day = min(relative_date.day, calendar.monthrange(year, month)[1])
+  return datetime.date(year, month, day)
+
+
+class TimeBudget(object):
+  """The time left to a request, checked between stages of work.
+
+  Checking the budget at points where the stored state is consistent lets a
+  task save its progress and re-enqueue itself before the runtime raises
+  DeadlineExceededError in the middle of an API call or a put.
+  """
+
+  def __init__(self, deadline=TASK_DEADLINE, margin=TASK_SAFETY_MARGIN,
+               start=None):
+    """Constructor for TimeBudget.
+
+    Args:
+      deadline: The number of seconds the request may run for. Defaults to
+          TASK_DEADLINE.
+      margin: The number of seconds to leave unused. Defaults to
+          TASK_SAFETY_MARGIN.
+      start: The time.time() value the request started at. Defaults to now.
+    """
+    self.deadline = deadline
+    self.margin = margin
+    self.start = time.time() if start is None else start
+
+  def remaining(self):  # pylint:disable-msg=C0103
+    """Returns the number of seconds left before the deadline."""
+    return self.deadline - (time.time() - self.start)
+
+  def exhausted(self):  # pylint:disable-msg=C0103
+    """Returns True if no more than the safety margin is left."""
+    return self.remaining() <= self.margin
+
+  def __repr__(self):
+    return 'TimeBudget(remaining={:.1f}, margin={})'.format(self.remaining(),
+                                                            self.margin)